@@ -0,0 +1,119 @@
+"""cyme.api.fastpath
+
+- WSGI application handling the most frequent requests (applying tasks,
+  bulk applying tasks and ping) directly, without going through the
+  Django middleware, URL resolver and views.
+
+- All other requests, and requests the fast path cannot handle,
+  are passed on to the Django WSGI handler.
+
+"""
+
+from __future__ import absolute_import
+
+import httplib as http
+import re
+import sys
+
+from traceback import format_exception
+
+from anyjson import serialize
+from cell.exceptions import NoReplyError, NoRouteError
+from django.core.signals import request_finished, request_started
+from django.http import QueryDict
+from kombu.utils.encoding import safe_repr
+
+from .views import (GET_METHODS, apply_webhook, apply_webhooks,
+                    parse_apply_path, parse_bulk)
+from .web import access_control_headers
+
+#: Content types of request bodies that can be handled by the fast path.
+FORM_CONTENT_TYPES = frozenset(['', 'application/x-www-form-urlencoded'])
+
+
+class FastPath(object):
+    """WSGI application applying tasks (single or bulk) and responding
+    to ping, passing any other request to ``fallback``.
+
+    :param fallback: WSGI application used for all other requests.
+
+    """
+    re_apply = re.compile(r'^/(?P<app>[^/]+)/queue/(?:!/)?(?P<rest>.+)$')
+    re_bulk = re.compile(
+            r'^/(?P<app>[^/]+)/queue/(?:!/)?(?P<queue>[^/]+)/bulk/?$')
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO') or '/'
+        if path == '/ping/':
+            return self.respond(start_response, http.OK, {'ok': 'pong'})
+        m = self.re_bulk.match(path)
+        if m:
+            # other methods are refused by the Django view.
+            if environ['REQUEST_METHOD'].upper() == 'POST':
+                return self.apply_bulk(environ, start_response,
+                                       **m.groupdict())
+            return self.fallback(environ, start_response)
+        m = self.re_apply.match(path)
+        if m and self.can_apply(environ):
+            return self.apply(environ, start_response, **m.groupdict())
+        return self.fallback(environ, start_response)
+
+    def can_apply(self, environ):
+        if environ['REQUEST_METHOD'].upper() in GET_METHODS:
+            return True
+        content_type = environ.get('CONTENT_TYPE') or ''
+        return content_type.split(';')[0].strip() in FORM_CONTENT_TYPES
+
+    def apply(self, environ, start_response, app, rest):
+        method = environ['REQUEST_METHOD'].upper()
+        params = QueryDict(environ.get('QUERY_STRING') or '')
+        data = None
+        if method not in GET_METHODS:
+            data = QueryDict(self.read_body(environ))
+        queue, url = parse_apply_path(rest)
+        return self.call(start_response, apply_webhook,
+                         app, queue, url, method, params, data)
+
+    def apply_bulk(self, environ, start_response, app, queue):
+        try:
+            tasks = parse_bulk(self.read_body(environ))
+        except ValueError, exc:
+            return self.respond(start_response, http.BAD_REQUEST,
+                                {'nok': [str(exc)]})
+        return self.call(start_response, apply_webhooks, app, queue, tasks)
+
+    def call(self, start_response, fun, *args):
+        # the request signals are sent like the Django handler does,
+        # so that database connections are closed after the request.
+        request_started.send(sender=self.__class__)
+        try:
+            reply = fun(*args)
+        except NoRouteError:
+            return self.respond(start_response, http.NOT_FOUND)
+        except NoReplyError:
+            return self.respond(start_response, http.REQUEST_TIMEOUT)
+        except Exception, exc:
+            return self.respond(start_response, http.INTERNAL_SERVER_ERROR,
+                    {'nok': [safe_repr(exc),
+                             ''.join(format_exception(*sys.exc_info()))]})
+        finally:
+            request_finished.send(sender=self.__class__)
+        return self.respond(start_response, http.ACCEPTED, reply)
+
+    def read_body(self, environ):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        return environ['wsgi.input'].read(length) if length else ''
+
+    def respond(self, start_response, status, data=None):
+        body = serialize(data) if data is not None else ''
+        headers = [('Content-Type', 'application/json'),
+                   ('Content-Length', str(len(body)))]
+        start_response('%s %s' % (status, http.responses[status]),
+                       headers + access_control_headers())
+        return [body]
@@ -24,8 +24,11 @@ urlpatterns = patterns('',
 
     (r'^admin/', include(admin.site.urls)),
     (r'^branches/(?P<branch>.+?)?/?$', views.Branch.as_view()),
+    (_o_(r'^APP/queue/!(?P<queue>[^/]+)/bulk/?$'),
+        views.apply_bulk.as_view()),
     (_o_(r'^APP/queue/!(?P<rest>.+)'), views.apply.as_view()),
     (_o_(r'^APP/queues/!/?$'), views.Queue.as_view()),
+    (_o_(r'^APP/queues/(?P<name>.+?)/depth/?$'), views.queue_depth.as_view()),
     (_o_(r'^APP/queues/!(?P<name>.+?)/?$'), views.Queue.as_view()),
     (_o_(r'^APP/instances/!(?P<name>.+?)/queues/(?P<queue>.+?)?/?$'),
         views.Consumer.as_view()),
@@ -34,6 +37,11 @@ urlpatterns = patterns('',
     (_o_(r'^APP/instances/!(?P<name>.+)?/stats/?'),
         views.instance_stats.as_view()),
     (_o_(r'^APP/instances/!(?P<name>.+?)?/?$'), views.Instance.as_view()),
+    (_o_(r'^APP/query/states/?$'), views.task_states.as_view()),
+    (_o_(r'^APP/query/results/?$'), views.task_results.as_view()),
+    (_o_(r'^APP/query/events/?$'), views.task_events_stream.as_view()),
+    (_o_(r'^APP/query/(?P<uuid>.+?)/events/?$'),
+        views.task_events_stream.as_view()),
     (_o_(r'^APP/query/(?P<uuid>.+?)/state/?'), views.task_state.as_view()),
     (_o_(r'^APP/query/(?P<uuid>.+?)/result/?'), views.task_result.as_view()),
     (_o_(r'^APP/query/(?P<uuid>.+?)/wait/?'), views.task_wait.as_view()),
@@ -5,10 +5,21 @@ from __future__ import with_statement
 
 import re
 
+from Queue import Empty
+from time import time
+
 from celery import current_app as celery
+from anyjson import deserialize
+from celery import states
+from celery.exceptions import TimeoutError
 from celery.result import AsyncResult
+from eventlet import GreenPool
+from kombu.utils.encoding import safe_repr
 
 from . import web
+from cyme.branch import placement
+from cyme.branch.confirms import confirms
+from cyme.branch.events import RECONNECTED, task_events
 from cyme.branch.controller import apps, branches, instances, queues
 from cyme.tasks import webhook
 from cyme.utils import uuid
@@ -17,13 +28,19 @@ from cyme.utils import uuid
 class Branch(web.ApiView):
 
     def get(self, request, branch=None):
-        return branches.get(branch) if branch else branches.all()
+        if branch:
+            return branches.get(branch)
+        if request.GET.get('url'):
+            return self.Stream(branches.url(stream=True))
+        return self.Stream(branches.all(stream=True))
 
 
 class App(web.ApiView):
 
     def get(self, request, app=None):
-        return apps.get(app).as_dict() if app else apps.all()
+        if app:
+            return apps.get(app).as_dict()
+        return self.Stream(apps.all(stream=True))
 
     def put(self, request, app=None):
         return self.Created(apps.add(app or uuid(),
@@ -38,17 +55,30 @@ class App(web.ApiView):
 class Instance(web.ApiView):
 
     def get(self, request, app, name=None, nowait=False):
-        return instances.get(name) if name else instances.all(app=app)
+        if name:
+            return instances.get(name)
+        return self.Stream(instances.all(app=app, stream=True))
 
     def delete(self, request, app, name, nowait=False):
         return self.Ok(instances.remove(name, nowait=nowait))
 
     def post(self, request, app, name=None, nowait=False):
+        params = self.params('broker', 'pool', 'arguments',
+                             'extra_config', 'policy',
+                             ('max_concurrency', int),
+                             ('min_concurrency', int))
+        # use the defaults of the model for concurrency not specified.
+        for key in ('max_concurrency', 'min_concurrency'):
+            if params[key] is None:
+                del params[key]
+        # only the policy aliases can be selected by clients,
+        # class names are reserved for the setting.
+        if params['policy'] is not None and \
+                params['policy'] not in placement.POLICIES:
+            return self.BadRequest({'nok': [
+                'Unknown placement policy: %r' % (params['policy'], )]})
         return self.Created(instances.add(name=name, app=app,
-                                      nowait=nowait,
-                                      **self.params('broker', 'pool',
-                                                    'arguments',
-                                                    'extra_config')))
+                                          nowait=nowait, **params))
 
     def put(self, *args, **kwargs):
         return self.NotImplemented('Operation is not idempotent: use POST')
@@ -70,7 +100,13 @@ class Consumer(web.ApiView):
 class Queue(web.ApiView):
 
     def get(self, request, app, name=None):
-        return queues.get(name) if name else queues.all()
+        if name:
+            return queues.get(name)
+        if self.get_param(('depth', bool))[1]:
+            names = queues.all()
+            depths = queues.depths(names, apps.get(app).get_broker())
+            return [queue_depth_dict(name, depths[name]) for name in names]
+        return self.Stream(queues.all(stream=True))
 
     def delete(self, request, app, name, nowait=False):
         return self.Ok(queues.delete(name))
@@ -82,54 +118,137 @@ class Queue(web.ApiView):
     post = put
 
 
+#: Methods where the request parameters are in the query string only.
+GET_METHODS = frozenset(['GET', 'HEAD'])
+
+re_find_queue = re.compile(r'/?(.+?)/?$')
+re_url_in_path = re.compile(r'(.+?/)(\w+://)(.+)')
+
+#: Max time in seconds to wait for the task event consumer to be ready.
+EVENTS_READY_TIMEOUT = 5.0
+
+#: Interval in seconds between reading the result backend for
+#: tasks waited for, in case task events were lost.
+EVENTS_RECHECK_INTERVAL = 15.0
+
+#: Max number of tasks read from the result backend in one batch.
+QUERY_CHUNK_SIZE = 500
+
+#: Max number of concurrent result backend reads, used if the
+#: result backend cannot read many tasks at once.
+QUERY_CONCURRENCY = 50
+
+
+def parse_apply_path(rest):
+    """Split the path of a request to apply a task into the
+    queue name (or :const:`None`) and the URL."""
+    path, url = rest, None
+    m = re_url_in_path.match(rest)
+    if m:
+        path, scheme, last = m.groups()
+        url = scheme + last if scheme else None
+    if path:
+        m = re_find_queue.match(path)
+        if m:
+            return m.groups()[0], url
+    return None, url
+
+
+def queue_route(queue):
+    """Returns the declaration of ``queue`` (a queue name or :const:`None`),
+    and the routing arguments used to send tasks to it."""
+    if queue:
+        queue = queues.get(queue)
+        return queue, {'exchange': queue['exchange'],
+                       'exchange_type': queue['exchange_type'],
+                       'routing_key': queue['routing_key']}
+    return None, {}
+
+
+def send_webhooks(broker, calls, **options):
+    """Send a webhook task for every ``(url, method, params, data)`` tuple
+    in ``calls``, returns the list of task ids.
+
+    The tasks are sent using a single producer, or with publisher confirms
+    if enabled by the ``CYME_PUBLISH_CONFIRMS`` setting, in which case
+    this returns when all of the tasks have been confirmed.
+
+    """
+    publisher = confirms.get(broker.url)
+    if publisher is not None:
+        return publisher.publish_many([(webhook, args, None, options)
+                                            for args in calls])
+    with broker.producers.acquire(block=True) as producer:
+        publisher = celery.amqp.TaskPublisher(
+                        connection=producer.connection,
+                        channel=producer.channel)
+        return [webhook.apply_async(args, publisher=publisher,
+                                    retry=True, **options).task_id
+                    for args in calls]
+
+
+def apply_webhook(app, queue, url, method, params, data):
+    """Send webhook task to ``queue`` (a queue name or :const:`None`),
+    returns a description of the task sent."""
+    broker = apps.get(app).get_broker()
+    queue, pargs = queue_route(queue)
+    task_id, = send_webhooks(broker, [(url, method, params, data)], **pargs)
+    return {'uuid': task_id, 'url': url,
+            'queue': queue, 'method': method,
+            'params': params, 'data': data,
+            'broker': broker.connection.as_uri()}
+
+
+def parse_bulk(body):
+    """Parse the JSON body of a bulk apply request, which must be a list
+    of ``{"url", "method", "params", "data"}`` objects.
+
+    Raises :exc:`ValueError` if the body is not valid.
+
+    """
+    try:
+        tasks = deserialize(body)
+    except Exception, exc:
+        raise ValueError('Body is not valid JSON: %r' % (exc, ))
+    if not isinstance(tasks, list) or not all(isinstance(task, dict)
+                                        and task.get('url')
+                                            for task in tasks):
+        raise ValueError('Body must be a list of '
+                         '{"url", "method", "params", "data"} objects')
+    return tasks
+
+
+def apply_webhooks(app, queue, tasks):
+    """Send a webhook task for every task in ``tasks`` (as returned
+    by :func:`parse_bulk`), returns the list of task ids."""
+    broker = apps.get(app).get_broker()
+    _, pargs = queue_route(queue)
+    return send_webhooks(broker, [(task['url'],
+                                   (task.get('method') or 'GET').upper(),
+                                   task.get('params') or {},
+                                   task.get('data')) for task in tasks],
+                         **pargs)
+
+
 class apply(web.ApiView):
-    get_methods = frozenset(['GET', 'HEAD'])
-    re_find_queue = re.compile(r'/?(.+?)/?$')
-    re_url_in_path = re.compile(r'(.+?/)(\w+://)(.+)')
-
-    def prepare_path(self, rest):
-        path, url = self._parse_path_containing_url(rest)
-        if path:
-            m = self.re_find_queue.match(path)
-            if m:
-                return m.groups()[0], url
-        return None, url
-
-    def dispatch(self, request, app, rest):
-        gd = lambda m: getattr(request, m)
-        queue, url = self.prepare_path(rest)
-        app = apps.get(app)
-        broker = app.get_broker()
+    get_methods = GET_METHODS
+
+    def dispatch(self, request, app, rest, nowait=None):
+        queue, url = parse_apply_path(rest)
         method = request.method.upper()
-        pargs = {}
-        if queue:
-            queue = queues.get(queue)
-            pargs.update(exchange=queue['exchange'],
-                         exchange_type=queue['exchange_type'],
-                         routing_key=queue['routing_key'])
-        params = gd(method) if method in self.get_methods else gd('GET')
-        data = gd(method) if method not in self.get_methods else None
-
-        with broker.producers.acquire(block=True) as producer:
-            publisher = celery.amqp.TaskPublisher(
-                            connection=producer.connection,
-                            channel=producer.channel)
-            result = webhook.apply_async((url, method, params, data),
-                                         publisher=publisher, retry=True,
-                                         **pargs)
-            return self.Accepted({'uuid': result.task_id, 'url': url,
-                                  'queue': queue, 'method': method,
-                                  'params': params, 'data': data,
-                                  'broker': producer.connection.as_uri()})
-
-        def _parse_path_containing_url(self, rest):
-            m = self.re_url_in_path.match(rest)
-            if m:
-                first, scheme, last = m.groups()
-                if scheme:
-                    return first, scheme + last
-                return first, None
-            return rest, None
+        data = request.POST if method not in self.get_methods else None
+        return self.Accepted(apply_webhook(app, queue, url, method,
+                                           request.GET, data))
+
+
+class apply_bulk(web.ApiView):
+
+    def post(self, request, app, queue, nowait=None):
+        try:
+            tasks = parse_bulk(request.raw_post_data)
+        except ValueError, exc:
+            return self.BadRequest({'nok': [str(exc)]})
+        return self.Accepted(apply_webhooks(app, queue, tasks))
 
 
 class autoscale(web.ApiView):
@@ -149,6 +268,19 @@ def instance_stats(self, request, app, name):
     return instances.stats(name)
 
 
+def queue_depth_dict(name, depth):
+    return dict({'name': name, 'messages': None, 'consumers': None},
+                **depth or {})
+
+
+@web.simple_get
+def queue_depth(self, request, app, name):
+    depth = queues.depths([name], apps.get(app).get_broker())[name]
+    if depth is None:
+        raise queues.NoRouteError(name)
+    return queue_depth_dict(name, depth)
+
+
 @web.simple_get
 def task_state(self, request, app, uuid):
     return {'state': AsyncResult(uuid).state}
@@ -159,9 +291,233 @@ def task_result(self, request, app, uuid):
     return {'result': AsyncResult(uuid).result}
 
 
-@web.simple_get
-def task_wait(self, request, app, uuid):
-    return {'result': AsyncResult(uuid).get()}
+def wait_for_task(app, uuid, timeout=None):
+    """Wait for task to be ready, returns the :class:`AsyncResult`
+    of the task, or :const:`None` if the timeout is exceeded.
+
+    When running as a branch this waits for the task events sent
+    by the instances, so the result backend is only read when the
+    task is ready, when the event consumer reconnects, and every
+    :data:`EVENTS_RECHECK_INTERVAL` seconds in case events were lost.
+
+    """
+    result = AsyncResult(uuid)
+    consumer = task_events.get(apps.get(app).get_broker().url)
+    if consumer is None:
+        try:
+            result.get(timeout=timeout, propagate=False)
+        except TimeoutError:
+            return None
+        return result
+    # subscribe and wait for the event consumer before
+    # reading the backend, so no events are lost.
+    queue = consumer.subscribe([uuid])
+    try:
+        deadline = time() + timeout if timeout is not None else None
+        consumer.wait_ready(min(timeout, EVENTS_READY_TIMEOUT)
+                                if timeout is not None
+                                else EVENTS_READY_TIMEOUT)
+        check = True
+        while 1:
+            if check and result.ready():
+                return result
+            wait = EVENTS_RECHECK_INTERVAL
+            if deadline is not None:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            try:
+                event = queue.get(timeout=wait)
+            except Empty:
+                check = True
+            else:
+                check = (event is RECONNECTED or
+                         event['state'] in states.READY_STATES)
+    finally:
+        consumer.unsubscribe([uuid], queue)
+
+
+def _ready_task_events(uuids):
+    # reads the state of tasks from the result backend,
+    # yielding the ones that are ready.
+    for uuid in list(uuids):
+        state = AsyncResult(uuid).state
+        if state in states.READY_STATES:
+            yield state, {'uuid': uuid, 'state': state}
+
+
+def iter_task_events(app, uuids, heartbeat=EVENTS_RECHECK_INTERVAL,
+        timeout=None):
+    """Yields ``(state, event)`` tuples with the current state of
+    the tasks in ``uuids``, followed by the state changes as they happen,
+    until all of the tasks are ready or ``timeout`` seconds has passed.
+
+    :const:`None` is yielded if nothing happens for ``heartbeat``
+    seconds, and the result backend is then read again for the tasks
+    not ready, in case events were lost.
+
+    """
+    consumer = task_events.get(apps.get(app).get_broker().url)
+    queue = consumer.subscribe(uuids)
+    try:
+        deadline = time() + timeout if timeout is not None else None
+        consumer.wait_ready(EVENTS_READY_TIMEOUT)
+        waiting = set()
+        for uuid in uuids:
+            state = AsyncResult(uuid).state
+            if state not in states.READY_STATES:
+                waiting.add(uuid)
+            yield state, {'uuid': uuid, 'state': state}
+        while waiting:
+            wait = heartbeat
+            if deadline is not None:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return
+                wait = min(wait, remaining)
+            try:
+                event = queue.get(timeout=wait)
+            except Empty:
+                event = None
+            if event is None or event is RECONNECTED:
+                for state, ready in _ready_task_events(waiting):
+                    waiting.discard(ready['uuid'])
+                    yield state, ready
+                if event is None:
+                    yield None
+                continue
+            if event['uuid'] in waiting:
+                if event['state'] in states.READY_STATES:
+                    waiting.discard(event['uuid'])
+                yield event['state'], event
+    finally:
+        consumer.unsubscribe(uuids, queue)
+
+
+def parse_uuids(body):
+    """Parse the JSON body of a bulk query request, which must be a list
+    of task ids.
+
+    Raises :exc:`ValueError` if the body is not valid.
+
+    """
+    try:
+        uuids = deserialize(body)
+    except Exception, exc:
+        raise ValueError('Body is not valid JSON: %r' % (exc, ))
+    if not isinstance(uuids, list) or not all(isinstance(uuid, basestring)
+                                                for uuid in uuids):
+        raise ValueError('Body must be a list of task ids')
+    return uuids
+
+
+def task_metas(uuids):
+    """Returns the state and result of many tasks as a
+    ``{uuid: {'status': state, 'result': result}}`` mapping.
+
+    The tasks are read in batches if the result backend supports it
+    (key/value store backends and the database backend),
+    and concurrently otherwise.
+
+    """
+    backend = celery.backend
+    if hasattr(backend, 'mget') and hasattr(backend, 'get_key_for_task'):
+        read = _mget_task_metas
+    elif hasattr(backend, 'TaskModel'):
+        read = _model_task_metas
+    else:
+        read = _fanout_task_metas
+    metas = dict((uuid, {'status': states.PENDING, 'result': None})
+                    for uuid in uuids)
+    uuids = list(metas)
+    for i in xrange(0, len(uuids), QUERY_CHUNK_SIZE):
+        chunk = uuids[i:i + QUERY_CHUNK_SIZE]
+        try:
+            metas.update(read(backend, chunk))
+        except NotImplementedError:
+            # the base KeyValueStoreBackend.mget is not implemented.
+            read = _fanout_task_metas
+            metas.update(read(backend, chunk))
+    return metas
+
+
+def _mget_task_metas(backend, uuids):
+    keys = [backend.get_key_for_task(uuid) for uuid in uuids]
+    values = backend.mget(keys)
+    if isinstance(values, dict):
+        values = [values.get(key) for key in keys]
+    return dict((uuid, backend.decode(value))
+                    for uuid, value in zip(uuids, values) if value)
+
+
+def _model_task_metas(backend, uuids):
+    return dict((meta.task_id, meta.to_dict())
+        for meta in backend.TaskModel._default_manager.filter(
+                                                    task_id__in=uuids))
+
+
+def _fanout_task_metas(backend, uuids):
+    pool = GreenPool(QUERY_CONCURRENCY)
+    return dict(zip(uuids, pool.imap(backend.get_task_meta, uuids)))
+
+
+def task_result_dict(meta):
+    result = meta.get('result')
+    if meta['status'] in states.EXCEPTION_STATES and result is not None:
+        result = safe_repr(result)
+    return {'state': meta['status'], 'result': result}
+
+
+class bulk_query(web.ApiView):
+    """Base class for views querying many tasks at once."""
+
+    def post(self, request, app):
+        apps.get(app)  # unknown apps are not found (404).
+        try:
+            uuids = parse_uuids(request.raw_post_data)
+        except ValueError, exc:
+            return self.BadRequest({'nok': [str(exc)]})
+        return dict((uuid, self.format(meta))
+                        for uuid, meta in task_metas(uuids).iteritems())
+
+
+class task_states(bulk_query):
+
+    def format(self, meta):
+        return meta['status']
+
+
+class task_results(bulk_query):
+
+    def format(self, meta):
+        return task_result_dict(meta)
+
+
+class task_wait(web.ApiView):
+
+    def get(self, request, app, uuid):
+        _, timeout = self.get_param(('timeout', float))
+        result = wait_for_task(app, uuid, timeout)
+        if result is None:
+            return self.Accepted({'uuid': uuid,
+                                  'state': AsyncResult(uuid).state})
+        return {'result': result.get()}
+
+
+class task_events_stream(web.ApiView):
+
+    def get(self, request, app, uuid=None):
+        uuids = [uuid] if uuid else [u
+                    for value in request.GET.getlist('uuid')
+                        for u in value.split(',') if u]
+        if not uuids:
+            return self.BadRequest({'nok': ['Missing uuid']})
+        if task_events.get(apps.get(app).get_broker().url) is None:
+            return self.NotImplemented('Task events requires a branch.')
+        _, timeout = self.get_param(('timeout', float))
+        return self.EventStream(iter_task_events(app, uuids,
+                                                 timeout=timeout))
 
 
 @web.simple_get
@@ -10,6 +10,7 @@ import httplib as http
 import sys
 
 from functools import partial
+from itertools import chain
 from traceback import format_exception
 
 from django.http import HttpResponse, HttpResponseNotFound
@@ -17,8 +18,16 @@ from django.views.generic.base import View
 
 from anyjson import serialize
 from cell.exceptions import NoReplyError, NoRouteError
+from kombu.log import get_logger
 from kombu.utils.encoding import safe_repr
 
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:  # Django < 1.5
+    StreamingHttpResponse = HttpResponse  # noqa
+
+logger = get_logger('cyme.api')
+
 # Cross Origin Resource Sharing
 # See: http://www.w3.org/TR/cors/
 ACCESS_CONTROL = {
@@ -39,15 +48,21 @@ class HttpResponseNotImplemented(HttpResponse):
     status_code = http.NOT_IMPLEMENTED
 
 
-def set_access_control_options(response, options=None):
+def access_control_headers(options=None):
+    """Returns the Access-Control headers as a list of
+    ``(header, value)`` tuples."""
     options = dict(ACCESS_CONTROL, **options or {})
     try:
         options['Allow-Methods'] = ', '.join(options['Allow-Methods'] or [])
     except KeyError:
         pass
+    return [('Access-Control-%s' % (key, ), str(value))
+                for key, value in options.iteritems()]
 
-    for key, value in ACCESS_CONTROL.iteritems():
-        response['Access-Control-%s' % (key, )] = value
+
+def set_access_control_options(response, options=None):
+    for key, value in access_control_headers(options):
+        response[key] = value
 
 
 def JsonResponse(data, status=http.OK, access_control=None, **kwargs):
@@ -62,15 +77,87 @@ def JsonResponse(data, status=http.OK, access_control=None, **kwargs):
     set_access_control_options(response, access_control)
     response.csrf_exempt = True
     return response
+
+
+def iter_json_array(it):
+    """Encode the values of an iterator as a JSON array,
+    yielding the values as they are encoded."""
+    yield '['
+    sep = ''
+    try:
+        for value in it:
+            yield sep + serialize(value)
+            sep = ', '
+    except Exception, exc:
+        # too late to change the response status, so the array ends
+        # with the values received so far.
+        logger.error('Error while streaming response: %r', exc,
+                     exc_info=sys.exc_info())
+    yield ']'
+
+
+def StreamingJsonResponse(it, status=http.OK, access_control=None,
+        **kwargs):
+    """Returns a response streaming the values of an iterator
+    as a JSON array (using chunked transfer encoding).
+
+    The first value is taken from the iterator before the response
+    is returned, so that errors like :exc:`NoRouteError` are raised
+    while the status of the response can still be changed.
+
+    """
+    it = iter(it)
+    try:
+        first = [next(it)]
+    except StopIteration:
+        first = []
+    kwargs.setdefault('content_type', 'application/json')
+    response = StreamingHttpResponse(iter_json_array(chain(first, it)),
+                                     status=status, **kwargs)
+    set_access_control_options(response, access_control)
+    response.csrf_exempt = True
+    return response
+
+
+def iter_event_stream(it):
+    """Encode ``(event, data)`` tuples from an iterator as
+    Server-Sent Events.  :const:`None` values are sent as comments,
+    to keep the connection alive."""
+    try:
+        for value in it:
+            if value is None:
+                yield ':\n\n'
+                continue
+            event, data = value
+            yield 'event: %s\ndata: %s\n\n' % (event, serialize(data))
+    except Exception, exc:
+        logger.error('Error while streaming events: %r', exc,
+                     exc_info=sys.exc_info())
+
+
+def EventStreamResponse(it, status=http.OK, access_control=None, **kwargs):
+    """Returns a response streaming ``(event, data)`` tuples
+    as Server-Sent Events."""
+    kwargs.setdefault('content_type', 'text/event-stream')
+    response = StreamingHttpResponse(iter_event_stream(it),
+                                     status=status, **kwargs)
+    response['Cache-Control'] = 'no-cache'
+    set_access_control_options(response, access_control)
+    response.csrf_exempt = True
+    return response
+
+
 Accepted = partial(JsonResponse, status=http.ACCEPTED)
 Created = partial(JsonResponse, status=http.CREATED)
 Error = partial(JsonResponse, status=http.INTERNAL_SERVER_ERROR)
+BadRequest = partial(JsonResponse, status=http.BAD_REQUEST)
 
 
 class ApiView(View):
     nowait = False  # should the current operation be async?
     typemap = {int: lambda i: int(i) if i else None,
-               float: lambda f: float(f) if f else None}
+               float: lambda f: float(f) if f else None,
+               bool: lambda b: b.lower() in ('1', 'true', 'yes', 'on')}
     _semipredicate = object()
 
     def dispatch(self, request, *args, **kwargs):
@@ -96,6 +183,12 @@ class ApiView(View):
     def Accepted(self, *args, **kwargs):
         return Accepted(*args, **kwargs)
 
+    def Stream(self, *args, **kwargs):
+        return StreamingJsonResponse(*args, **kwargs)
+
+    def EventStream(self, *args, **kwargs):
+        return EventStreamResponse(*args, **kwargs)
+
     def Ok(self, data, *args, **kwargs):
         if self.nowait:
             data = data or {'ok': 'operation scheduled'}
@@ -108,6 +201,9 @@ class ApiView(View):
             return self.Accepted(data, **kwargs)
         return Created(data, *args, **kwargs)
 
+    def BadRequest(self, *args, **kwargs):
+        return BadRequest(*args, **kwargs)
+
     def NotImplemented(self, *args, **kwargs):
         return HttpResponseNotImplemented(*args, **kwargs)
 
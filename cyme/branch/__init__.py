@@ -39,6 +39,10 @@ class Branch(gThread):
     controller_cls = '.controller.Controller'
     httpd_cls = '.httpd.HttpServer'
     supervisor_cls = '.supervisor.Supervisor'
+    heartbeats_cls = '.heartbeats.Heartbeats'
+    replies_cls = '.replies.Replies'
+    autoscaler_cls = '.autoscaler.Autoscaler'
+    confirms_cls = '.confirms.Confirms'
     intsup_cls = '.intsup.gSup'
 
     _components_ready = {}
@@ -48,7 +52,7 @@ class Branch(gThread):
 
     def __init__(self, addrport='', id=None, loglevel=logging.INFO,
             logfile=None, without_httpd=False, numc=2, sup_interval=None,
-            ready_event=None, colored=None, **kwargs):
+            sup_concurrency=None, ready_event=None, colored=None, **kwargs):
         self.id = id or gen_unique_id()
         if isinstance(addrport, basestring):
             addr, _, port = addrport.partition(':')
@@ -68,14 +72,26 @@ class Branch(gThread):
             self.httpd = MockSup(instantiate(self, self.httpd_cls, addrport),
                               signals.httpd_ready)
         self.supervisor = gSup(instantiate(self, self.supervisor_cls,
-                                sup_interval), signals.supervisor_ready)
+                                sup_interval,
+                                concurrency=sup_concurrency),
+                               signals.supervisor_ready)
+        self.heartbeats = gSup(instantiate(self, self.heartbeats_cls),
+                               signals.heartbeats_ready)
+        self.replies = gSup(instantiate(self, self.replies_cls),
+                            signals.replies_ready)
+        self.autoscaler = gSup(instantiate(self, self.autoscaler_cls),
+                               signals.autoscaler_ready)
+        self.confirms = gSup(instantiate(self, self.confirms_cls),
+                             signals.confirms_ready)
         self.controllers = [gSup(instantiate(self, self.controller_cls,
                                    id='%s.%s' % (self.id, i),
                                    connection=self.connection,
                                    branch=self),
                                  signals.controller_ready)
                                 for i in xrange(1, numc + 1)]
-        c = [self.supervisor] + self.controllers + [self.httpd]
+        c = ([self.replies, self.confirms, self.supervisor,
+              self.heartbeats, self.autoscaler] + self.controllers
+                + [self.httpd])
         c = self.components = list(filter(None, c))
         self._components_ready = dict(zip([z.thread for z in c],
                                           [False] * len(c)))
@@ -102,6 +118,10 @@ class Branch(gThread):
         signals.controller_ready.connect(self._component_ready)
         signals.httpd_ready.connect(self._component_ready)
         signals.supervisor_ready.connect(self._component_ready)
+        signals.heartbeats_ready.connect(self._component_ready)
+        signals.replies_ready.connect(self._component_ready)
+        signals.autoscaler_ready.connect(self._component_ready)
+        signals.confirms_ready.connect(self._component_ready)
         signals.presence_ready.connect(self._component_ready)
         signals.branch_ready.connect(self.on_ready)
         signals.thread_post_shutdown.connect(self._component_shutdown)
@@ -142,6 +162,7 @@ class Branch(gThread):
                 'loglevel': LOG_LEVELS[self.loglevel],
                 'numc': self.numc,
                 'sup_interval': self.supervisor.interval,
+                'sup_concurrency': self.supervisor.thread.concurrency,
                 'logfile': self.logfile,
                 'port': port,
                 'url': url}
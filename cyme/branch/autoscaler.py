@@ -0,0 +1,190 @@
+"""cyme.branch.autoscaler
+
+- Adjusts the concurrency of the instances on this branch
+  by the number of messages waiting in the queues they consume from.
+
+- The worker autoscaler only knows about the tasks it has already
+  reserved, so this raises the min concurrency of the worker
+  autoscaler when the queues grows, and lowers it again when the
+  queues are drained.  The concurrency is always kept within the
+  max/min concurrency set for the instance.
+
+"""
+
+from __future__ import absolute_import
+
+from collections import defaultdict
+from math import ceil
+from time import sleep, time
+
+from celery.local import Proxy
+
+from .signals import autoscaler_ready
+from .thread import gThread
+
+from cyme import conf
+from cyme.models import Instance
+
+__current = None
+
+
+class Autoscaler(gThread):
+    """Samples the queue depths of the instances on this branch
+    at intervals, and scales the instances accordingly.
+
+    Only enabled instances with a ``max_concurrency`` higher than their
+    ``min_concurrency`` are autoscaled.
+
+    :keyword interval: Interval (in seconds as an int/float) between
+        sampling the queues (default is the ``CYME_AUTOSCALE_INTERVAL``
+        setting).
+    :keyword tasks_per_process: Number of waiting messages each process
+        is expected to handle (default is the
+        ``CYME_AUTOSCALE_TASKS_PER_PROCESS`` setting).
+
+    """
+    Instances = Instance._default_manager
+
+    #: Default interval.
+    interval = None
+
+    #: Default number of waiting messages per process.
+    tasks_per_process = None
+
+    #: The concurrency is only decreased when there are less
+    #: than this fraction of :attr:`tasks_per_process` messages
+    #: per process, so instances does not flap between two values.
+    scale_down_ratio = 0.5
+
+    #: Min number of seconds between increasing the concurrency
+    #: of an instance.
+    scale_up_cooldown = 30.0
+
+    #: Min number of seconds between decreasing the concurrency
+    #: of an instance.
+    scale_down_cooldown = 120.0
+
+    def __init__(self, interval=None, tasks_per_process=None,
+            set_as_current=True):
+        self.interval = (interval or self.interval
+                                  or conf.CYME_AUTOSCALE_INTERVAL)
+        self.tasks_per_process = (tasks_per_process
+                                    or self.tasks_per_process
+                                    or conf.CYME_AUTOSCALE_TASKS_PER_PROCESS)
+        if set_as_current:
+            set_current(self)
+        # instance name -> min concurrency set by the autoscaler.
+        self.floors = {}
+        # instance name -> time of last change.
+        self.last_scaled = {}
+        super(Autoscaler, self).__init__()
+
+    def min_for(self, instance):
+        """Returns the min concurrency the worker autoscaler
+        of an instance should currently be using."""
+        floor = self.floors.get(instance.name)
+        if floor is None:
+            return instance.min_concurrency
+        return max(instance.min_concurrency,
+                   min(floor, instance.max_concurrency))
+
+    def before(self):
+        self.start_periodic_timer(self.interval, self.scale_all)
+
+    def run(self):
+        self.info('started')
+        autoscaler_ready.send(sender=self)
+        while not self.should_stop:
+            self.respond_to_ping()
+            sleep(1.0)
+
+    def scale_all(self):
+        """Sample the queues and scale all autoscaled instances."""
+        instances = [instance for instance in self.Instances.enabled()
+                        if instance.max_concurrency >
+                            instance.min_concurrency]
+        names = set(instance.name for instance in instances)
+        for name in set(self.floors) - names:
+            self.floors.pop(name, None)
+            self.last_scaled.pop(name, None)
+        by_broker = defaultdict(list)
+        for instance in instances:
+            by_broker[instance.broker.url].append(instance)
+        for group in by_broker.itervalues():
+            try:
+                self.scale_group(group)
+            except Exception, exc:
+                self.error('Autoscaling instances using %s raised: %r',
+                           group[0].broker.url, exc)
+
+    def scale_group(self, instances):
+        queues = set(q for instance in instances for q in instance.queues)
+        depths = instances[0].broker.queue_depths(queues)
+        stats = Instance.query_all(instances, 'stats')
+        for instance in instances:
+            try:
+                autoscaler = stats[instance.name]['autoscaler']
+            except (TypeError, KeyError):
+                continue  # not running, or not using --autoscale.
+            self.scale(instance, depths, autoscaler)
+
+    def scale(self, instance, depths, autoscaler):
+        """Scale instance using the queue ``depths`` and the stats of
+        the worker ``autoscaler``."""
+        current = self.min_for(instance)
+        target = self.target(instance, depths, autoscaler, current)
+        if target == current:
+            return
+        cooldown = (self.scale_up_cooldown if target > current
+                        else self.scale_down_cooldown)
+        if time() - self.last_scaled.get(instance.name, 0) < cooldown:
+            return
+        self.info('%s: scaling min concurrency %s -> %s',
+                  instance.name, current, target)
+        self.floors[instance.name] = target
+        self.last_scaled[instance.name] = time()
+        self._set_min(instance, target)
+
+    def target(self, instance, depths, autoscaler, current):
+        """Returns the min concurrency the instance should have."""
+        # the waiting messages are shared between all consumers
+        # of a queue, and reserved messages are already
+        # waiting in the worker.
+        backlog = float(autoscaler.get('qty') or 0)
+        for queue in instance.queues:
+            depth = depths.get(queue)
+            if depth:
+                backlog += depth['messages'] / float(depth['consumers'] or 1)
+        per_process = float(self.tasks_per_process)
+        up = int(ceil(backlog / per_process))
+        down = int(ceil(backlog / (per_process * self.scale_down_ratio)))
+        target = current
+        if up > current:
+            target = up
+        elif down < current:
+            target = down
+        return max(instance.min_concurrency,
+                   min(target, instance.max_concurrency))
+
+    def _set_min(self, instance, min):
+        instance.autoscale(instance.max_concurrency, min, save=False)
+
+
+class _OfflineAutoscaler(object):
+
+    def min_for(self, instance):
+        return instance.min_concurrency
+
+
+def set_current(autoscaler):
+    global __current
+    __current = autoscaler
+    return __current
+
+
+def get_current():
+    if __current is None:
+        return _OfflineAutoscaler()
+    return __current
+
+autoscaler = Proxy(get_current)
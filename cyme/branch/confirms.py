@@ -0,0 +1,289 @@
+"""cyme.branch.confirms
+
+- Publishes task messages with publisher confirms, so that a task
+  is only reported as sent when the broker has taken responsibility
+  for it.
+
+- Waiting for a confirm after every message would add a round trip
+  to every request, so instead the publishes from concurrent
+  requests are gathered into short batching windows, published
+  on a single channel per broker, and each request is woken up
+  when the confirm for its message arrives.
+
+- Enabled by the ``CYME_PUBLISH_CONFIRMS`` setting, and requires
+  a transport supporting publisher confirms (e.g. ``pyamqp``).
+
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import socket
+
+from Queue import Empty
+from time import sleep, time
+
+from celery import current_app as celery
+from celery.amqp import TaskPublisher
+from celery.local import Proxy
+from eventlet import Timeout
+from eventlet.event import Event
+from eventlet.queue import LightQueue
+
+from .signals import confirms_ready
+from .thread import gThread
+
+from cyme import conf
+
+__current = None
+
+
+class ConfirmsNotSupported(Exception):
+    """Raised if the transport does not support publisher confirms."""
+
+
+class ConfirmTimeout(Exception):
+    """Raised if a message was not confirmed in time."""
+
+
+class PublishNacked(Exception):
+    """Raised if the broker could not take responsibility
+    for a message."""
+
+
+class ConfirmPublisher(object):
+    """Publishes task messages to one broker using publisher confirms.
+
+    :keyword window: Time in seconds to gather publishes before
+        sending a batch (default is the ``CYME_PUBLISH_CONFIRM_WINDOW``
+        setting).
+    :keyword timeout: Time in seconds to wait for the confirm of a
+        message (default is the ``CYME_PUBLISH_CONFIRM_TIMEOUT`` setting).
+
+    """
+
+    #: Time in seconds to wait before reconnecting after
+    #: a connection error.
+    retry_interval = 2.0
+
+    #: Max number of messages published in one batch.
+    max_batch = 1000
+
+    def __init__(self, url, thread, window=None, timeout=None):
+        self.url = url
+        self.thread = thread
+        self.window = (window if window is not None
+                            else conf.CYME_PUBLISH_CONFIRM_WINDOW)
+        self.timeout = timeout or conf.CYME_PUBLISH_CONFIRM_TIMEOUT
+        self.pending = LightQueue()
+        self.supported = True
+        self._reset()
+        self.g = thread.spawn(self._publish_loop)
+
+    def publish(self, task, args, kwargs=None, **options):
+        """Send ``task`` with the next batch, and return its task id
+        when the broker has confirmed the message.
+
+        :raises ConfirmTimeout: if the message was not confirmed
+            within the timeout.
+        :raises PublishNacked: if the broker rejected the message.
+
+        """
+        return self.publish_many([(task, args, kwargs, options)])[0]
+
+    def publish_many(self, messages):
+        """Like :meth:`publish`, but sends a list of
+        ``(task, args, kwargs, options)`` tuples and returns
+        the list of task ids."""
+        if not self.supported:
+            raise ConfirmsNotSupported(
+                'Transport of %s does not support publisher confirms' % (
+                    self.url, ))
+        events = []
+        for task, args, kwargs, options in messages:
+            event = Event()
+            self.pending.put((task, args, kwargs, options, event))
+            events.append(event)
+        with Timeout(self.timeout, ConfirmTimeout(
+                'Publish to %s not confirmed in time' % (self.url, ))):
+            return [event.wait() for event in events]
+
+    def on_ack(self, delivery_tag, multiple=False):
+        self._settle(delivery_tag, multiple)
+
+    def on_nack(self, delivery_tag, multiple=False):
+        self.nacked.update(self._settle(delivery_tag, multiple))
+
+    def _settle(self, delivery_tag, multiple):
+        if multiple:
+            settled = set(tag for tag in self.unconfirmed
+                                if tag <= delivery_tag)
+        else:
+            settled = set([delivery_tag]) & self.unconfirmed
+        self.unconfirmed -= settled
+        return settled
+
+    def _reset(self):
+        # delivery tags are numbered from 1 for every new channel.
+        self.delivery_tag = 0
+        self.unconfirmed = set()
+        self.nacked = set()
+
+    def _publish_loop(self):
+        while not self.thread.should_stop:
+            try:
+                with celery.broker_connection(self.url) as conn:
+                    channel = self._confirm_channel(conn)
+                    while not self.thread.should_stop:
+                        batch = self._collect()
+                        if batch:
+                            self._flush(conn, channel, batch)
+            except ConfirmsNotSupported, exc:
+                self.supported = False
+                self.thread.error('%s', exc)
+                self._fail_pending(exc)
+                return
+            except Exception, exc:
+                self.thread.error('Confirm publisher for %s raised: %r',
+                                  self.url, exc)
+                sleep(self.retry_interval)
+
+    def _confirm_channel(self, conn):
+        channel = conn.channel()
+        if not hasattr(channel, 'confirm_select') or \
+                not hasattr(channel, 'events'):
+            raise ConfirmsNotSupported(
+                'Transport of %s does not support publisher confirms' % (
+                    self.url, ))
+        self._reset()
+        channel.events['basic_ack'].add(self.on_ack)
+        channel.events['basic_nack'].add(self.on_nack)
+        channel.confirm_select()
+        return channel
+
+    def _collect(self):
+        try:
+            batch = [self.pending.get(timeout=1.0)]
+        except Empty:
+            return []
+        # wait for the publishes of concurrent requests.
+        sleep(self.window)
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.pending.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _flush(self, conn, channel, batch):
+        publisher = TaskPublisher(connection=conn, channel=channel)
+        sent = []
+        try:
+            for task, args, kwargs, options, event in batch:
+                try:
+                    result = task.apply_async(args, kwargs,
+                                              publisher=publisher,
+                                              retry=False, **options)
+                except conn.connection_errors + conn.channel_errors:
+                    raise
+                except Exception, exc:
+                    event.send_exception(exc)
+                    continue
+                self.delivery_tag += 1
+                self.unconfirmed.add(self.delivery_tag)
+                sent.append((self.delivery_tag, result.task_id, event))
+            self._wait_for_confirms(conn)
+        except Exception, exc:
+            # the connection is reestablished, so the outcome of the
+            # messages not yet confirmed is unknown and the
+            # requests must retry.
+            self._notify(sent, exc)
+            for task, args, kwargs, options, event in batch:
+                if not event.ready():
+                    event.send_exception(exc)
+            raise
+        self._notify(sent)
+
+    def _notify(self, sent, exc=None):
+        for delivery_tag, task_id, event in sent:
+            if delivery_tag in self.unconfirmed:
+                event.send_exception(exc)
+            elif delivery_tag in self.nacked:
+                event.send_exception(PublishNacked(
+                    'Broker did not accept task %s' % (task_id, )))
+            else:
+                event.send(task_id)
+        self.nacked.clear()
+
+    def _wait_for_confirms(self, conn):
+        deadline = time() + self.timeout
+        while self.unconfirmed:
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise ConfirmTimeout('%s unconfirmed messages' % (
+                                        len(self.unconfirmed), ))
+            try:
+                conn.drain_events(timeout=remaining)
+            except socket.timeout:
+                pass
+
+    def _fail_pending(self, exc):
+        while 1:
+            try:
+                self.pending.get_nowait()[-1].send_exception(exc)
+            except Empty:
+                break
+
+
+class Confirms(gThread):
+    """Keeps one :class:`ConfirmPublisher` for every broker
+    tasks are sent to."""
+    Publisher = ConfirmPublisher
+
+    def __init__(self, set_as_current=True):
+        if set_as_current:
+            set_current(self)
+        self.publishers = {}
+        super(Confirms, self).__init__()
+
+    def get(self, url):
+        """Returns the confirm publisher for broker ``url``,
+        or :const:`None` if publisher confirms are disabled."""
+        if not conf.CYME_PUBLISH_CONFIRMS:
+            return
+        try:
+            return self.publishers[url]
+        except KeyError:
+            publisher = self.publishers[url] = self.Publisher(url, self)
+            return publisher
+
+    def run(self):
+        self.info('started')
+        confirms_ready.send(sender=self)
+        while not self.should_stop:
+            self.respond_to_ping()
+            sleep(1.0)
+
+    def after(self):
+        for publisher in self.publishers.itervalues():
+            publisher.g.kill()
+
+
+class _OfflineConfirms(object):
+
+    def get(self, url):
+        pass
+
+
+def set_current(confirms):
+    global __current
+    __current = confirms
+    return __current
+
+
+def get_current():
+    if __current is None:
+        return _OfflineConfirms()
+    return __current
+
+confirms = Proxy(get_current)
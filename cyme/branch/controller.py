@@ -6,25 +6,46 @@
 
 from __future__ import absolute_import
 
-from functools import partial
+from collections import defaultdict
+from functools import partial, wraps
+from multiprocessing import cpu_count
 
-from cell.presence import AwareActorMixin, announce_after
+from cell.g import spawn
+from cell.presence import AwareActorMixin
 from cell.utils import flatten, first_or_raise, shortuuid
 from celery import current_app as celery
+from django.db.models import Sum
+from django.db.models.signals import post_save
 from kombu import Exchange
 from kombu.common import uuid
 
 from . import metrics
+from . import placement
 from . import signals
+from .routing import Presence, VersionedMeta
 from .state import state
 from .thread import gThread
 
 from cyme import conf
 from cyme import models
-from cyme.utils import cached_property, find_symbol, promise
+from cyme.utils import LRUCache, cached_property, find_symbol, \
+                       force_list, promise
 from cyme.utils.actors import Actor, AwareAgent
 
 
+def announce_after(fun):
+    """Decorates actor state methods changing the entities owned by
+    this branch, so the changes are announced when the method returns."""
+
+    @wraps(fun)
+    def _inner(self, *args, **kwargs):
+        try:
+            return fun(self, *args, **kwargs)
+        finally:
+            self.actor.announce_changes()
+    return _inner
+
+
 class CymeActor(Actor, AwareActorMixin):
     _announced = set()  # note: global
 
@@ -33,10 +54,78 @@ class CymeActor(Actor, AwareActorMixin):
         self.retry = state.is_branch
         self.default_fields = {'actor_id': self.id}
 
+    def lookup(self, value):
+        # uses the routing index, which means the message is scattered
+        # if the owner is not known (e.g. has not announced it yet).
+        if self.agent:
+            return self.agent.presence.state.owner(
+                        self.name, self.meta_lookup_section, value)
+
+    def send_to_able(self, method, args={}, to=None, **kwargs):
+        """Sends the message to the owner of ``to`` if known by the
+        routing index, or scatters it otherwise.
+
+        Raises :exc:`~cell.exceptions.NoRouteError` if no branch
+        replied to the scatter (unless ``nowait`` is set).
+
+        """
+        actor = self.lookup(to)
+        if actor:
+            return self.send(method, args, to=actor, **kwargs)
+        replies = self.scatter(method, args, propagate=True, **kwargs)
+        if not kwargs.get('nowait'):
+            return first_or_raise(replies or (), self.NoRouteError(to))
+
+    def iscatter(self, method, args={}, **kwargs):
+        """Like :meth:`scatter`, but flattens the replies and yields
+        the values as soon as each branch replies.
+
+        Stops when all of the branches known by presence have replied,
+        or the timeout is exceeded.
+
+        """
+        for reply in self.scatter(method, args, **kwargs):
+            if reply:
+                for value in force_list(reply):
+                    yield value
+
+    def listing(self, method, args={}, stream=False, indexed=False, **kw):
+        """Returns the flattened replies of scattering ``method`` to
+        all branches, or an iterator yielding them as they arrive if
+        ``stream`` is set.
+
+        If ``indexed`` is set the values are taken from the routing index
+        when it is complete.
+
+        """
+        values = self.indexed() if indexed else None
+        if values is not None:
+            return iter(values) if stream else values
+        if stream:
+            return self.iscatter(method, args, **kw)
+        return flatten(self.scatter(method, args, **kw))
+
+    def indexed(self):
+        """Returns the values in :attr:`meta_lookup_section` for all
+        branches, or :const:`None` if the routing index is not
+        complete yet."""
+        if self.agent:
+            return self.agent.presence.state.values_for(
+                        self.name, self.meta_lookup_section)
+
 
 class ModelActor(CymeActor):
     model = None
 
+    #: Number of changes announced for every actor name.  The entities
+    #: are shared by all the controllers of the branch, so the change
+    #: must be included in the meta sent by each of them.
+    _changes = defaultdict(int)  # note: global
+
+    #: Value of :attr:`_changes` last included in the meta
+    #: of this controller.
+    _changes_seen = 0
+
     def on_agent_ready(self):
         if self.name not in self._announced:
             self.log.info('%s: %s', self.name_plural,
@@ -48,6 +137,36 @@ class ModelActor(CymeActor):
         state.objects = self.model._default_manager
         return Actor.contribute_to_state(self, state)
 
+    def announce_changes(self):
+        """Send a presence heartbeat including the entities
+        added/removed since the last announcement."""
+        self._changes[self.name] += 1
+        if self.agent:
+            self.agent.presence.send_heartbeat()
+
+    def presence_meta(self, snapshot=False):
+        if not self.meta_lookup_section:
+            return self.meta
+        changes = self._changes[self.name]
+        if changes != self._changes_seen:
+            self._changes_seen = changes
+            self.versioned_meta.changed()
+        return self.versioned_meta(snapshot=snapshot)
+
+    @property
+    def meta(self):
+        if not self.meta_lookup_section:
+            return {}
+        return {self.meta_lookup_section: list(self._meta_values())}
+
+    def _meta_values(self):
+        return self.state.objects.values_list('name', flat=True)
+
+    @cached_property
+    def versioned_meta(self):
+        return VersionedMeta(self.meta_lookup_section, self._meta_values,
+                             conf.CYME_PRESENCE_SNAPSHOT_INTERVAL)
+
     @cached_property
     def name(self):
         return unicode(self.model._meta.verbose_name.capitalize())
@@ -86,16 +205,16 @@ class Branch(CymeActor):
                 raise SystemExit()
             raise self.Next()
 
-    def all(self, **kw):
-        return flatten(self.scatter('id', **kw))
+    def all(self, stream=False, **kw):
+        return self.listing('id', stream=stream, indexed=True, **kw)
 
     def get(self, id, **kw):
         return self.send_to_able('about', to=id, **kw)
 
-    def url(self, id=None, **kw):
+    def url(self, id=None, stream=False, **kw):
         if id:
             return self.send_to_able('url', to=id, **kw)
-        return flatten(self.scatter('url', **kw))
+        return self.listing('url', stream=stream, **kw)
 
     def shutdown(self, id):
         return self.send_to_able('shutdown', {'id': id}, to=id, nowait=True)
@@ -110,11 +229,17 @@ branches = Branch()
 
 
 class App(ModelActor):
-    """Actor for managing the app model."""
+    """Actor for managing the app model.
+
+    Apps are cached by :meth:`get`, and the cache entries are invalidated
+    on all branches when the app is changed or deleted.
+
+    """
     model = models.App
     types = ('scatter', )
     exchange = Exchange('cyme.App')
-    _cache = {}
+    _cache = LRUCache(limit=conf.CYME_APP_CACHE_LIMIT,
+                      ttl=conf.CYME_APP_CACHE_TTL)  # note: global
 
     class state:
 
@@ -122,13 +247,21 @@ class App(ModelActor):
             return [app.name for app in self.objects.all()]
 
         def add(self, name, broker=None, arguments=None, extra_config=None):
+            self.invalidate(name)
             return self.objects.add(name, broker=broker,
                                           arguments=arguments,
                                           extra_config=extra_config).as_dict()
 
         def delete(self, name):
+            self.invalidate(name)
             return self.objects.filter(name=name).delete() and 'ok'
 
+        def invalidate(self, name):
+            self.actor._cache.pop(name, None)
+
+        def cache_info(self):
+            return self.actor._cache.info()
+
         def get(self, name):
             try:
                 return self.objects.get(name=name).as_dict()
@@ -140,8 +273,8 @@ class App(ModelActor):
             return {'load_average': metrics.load_average(),
                     'disk_use': metrics.df(instance_dir).capacity}
 
-    def all(self):
-        return flatten(self.scatter('all'))
+    def all(self, stream=False):
+        return self.listing('all', stream=stream)
 
     def add(self, name, **broker):
         self.scatter('add', dict({'name': name}, **broker), nowait=True)
@@ -154,17 +287,28 @@ class App(ModelActor):
     def metrics(self, name=None):
         return list(self.scatter('metrics'))
 
+    def invalidate(self, name):
+        """Remove app from the caches of all branches."""
+        self._cache.pop(name, None)
+        self.scatter('invalidate', {'name': name}, nowait=True)
+
+    def cache_info(self):
+        """Returns the app cache size and hit/miss counters
+        for every branch."""
+        return list(self.scatter('cache_info'))
+
     def get(self, name=None):
         objects = self.state.objects
         if not name:
             return objects.get_default()
-        if name not in self._cache:
+        try:
+            return self._cache[name]
+        except KeyError:
             app = self._get(name)
             if not app:
                 raise KeyError(name)
-            self._cache[name] = objects.recreate(**app)
-
-        return self._cache[name]
+            app = self._cache[name] = objects.recreate(**app)
+            return app
 
     def _get(self, name):
         try:
@@ -176,6 +320,12 @@ class App(ModelActor):
 apps = App()
 
 
+def _on_app_changed(sender, instance, created=False, **kwargs):
+    if not created and state.is_branch:
+        apps.invalidate(instance.name)
+post_save.connect(_on_app_changed, sender=models.App)
+
+
 class Instance(ModelActor):
     """Actor for managing the Instance model."""
     model = models.Instance
@@ -238,6 +388,17 @@ class Instance(ModelActor):
         def stats(self, name):
             return self.local.get(name).stats()
 
+        def load(self):
+            enabled = self.objects.enabled()
+            processes = enabled.aggregate(n=Sum('max_concurrency'))['n']
+            instance_dir = str(conf.CYME_INSTANCE_DIR)
+            return {'id': self.agent.id,
+                    'load_average': metrics.load_average(),
+                    'cpus': cpu_count(),
+                    'disk_use': metrics.df(instance_dir).capacity,
+                    'instances': enabled.count(),
+                    'processes': processes or 0}
+
         @cached_property
         def local(self):
             return find_symbol(self, '.managers.local_instances')
@@ -246,17 +407,55 @@ class Instance(ModelActor):
         return self.send_to_able('get',
                                  {'name': name, 'app': app}, to=name, **kw)
 
-    def all(self, app=None):
-        return flatten(self.scatter('all', {'app': app}))
+    def all(self, app=None, stream=False):
+        # the index does not know the app of an instance,
+        # so listings for an app are always scattered.
+        return self.listing('all', {'app': app}, stream=stream)
 
-    def add(self, name=None, app=None, nowait=False, **kwargs):
+    def add(self, name=None, app=None, nowait=False, policy=None,
+            **kwargs):
         if nowait:
             name = name if name else uuid()
-        ret = self.throw('add', dict({'name': name, 'app': app}, **kwargs),
-                         nowait=nowait)
+        args = dict({'name': name, 'app': app}, **kwargs)
+        policy = placement.get_policy(policy)
         if nowait:
+            if policy is None:
+                self.throw('add', args, nowait=True)
+            else:
+                # placement must wait for the load of all branches,
+                # so it is done in the background.
+                spawn(self._add_placed, args, policy, nowait=True)
             return {'name': name}
-        return ret
+        return self._add_placed(args, policy)
+
+    def _add_placed(self, args, policy, nowait=False):
+        try:
+            target = self._place(args, policy)
+            if target:
+                return self.send('add', args, to=target, nowait=nowait)
+            return self.throw('add', args, nowait=nowait)
+        except Exception, exc:
+            if not nowait:
+                raise
+            self.log.error('Could not add instance %s: %r',
+                           args['name'], exc)
+
+    def place(self, spec, policy=None):
+        """Returns the id of the agent a new instance should be added to,
+        using a placement policy (default is the ``CYME_PLACEMENT_POLICY``
+        setting), or :const:`None` if the instance can be added to any
+        branch."""
+        return self._place(spec, placement.get_policy(policy))
+
+    def _place(self, spec, policy):
+        if policy is not None:
+            loads = [load for load in self.scatter('load', propagate=False)
+                        if isinstance(load, dict)]
+            return policy.select(loads, spec)
+
+    def load(self):
+        """Returns the load of all branches."""
+        return list(self.scatter('load'))
 
     def remove(self, name, **kw):
         return self.send_to_able('remove', {'name': name}, to=name, **kw)
@@ -292,10 +491,6 @@ class Instance(ModelActor):
 
     def stats(self, name, **kw):
         return self.send_to_able('stats', {'name': name}, to=name, **kw)
-
-    @property
-    def meta(self):
-        return {'instances': self.state.all()}
 instances = Instance()
 
 
@@ -306,6 +501,8 @@ class Queue(ModelActor):
     types = ('direct', 'scatter', 'round-robin')
     default_timeout = 2
     meta_lookup_section = 'queues'
+    _depths = LRUCache(limit=10000,
+                       ttl=conf.CYME_QUEUE_DEPTH_TTL)  # note: global
 
     class state:
 
@@ -327,8 +524,8 @@ class Queue(ModelActor):
             self.objects.filter(name=name).delete()
             return 'ok'
 
-    def all(self):
-        return flatten(self.scatter('all'))
+    def all(self, stream=False):
+        return self.listing('all', stream=stream, indexed=True)
 
     def get(self, name):
         try:
@@ -345,9 +542,28 @@ class Queue(ModelActor):
         instances.remove_queue_from_all(name, nowait=True)
         return self.send_to_able('delete', {'name': name}, to=name, **kw)
 
-    @property
-    def meta(self):
-        return {'queues': self.state.all()}
+    def depths(self, names, broker):
+        """Returns the number of messages and consumers of queues on
+        ``broker``, as a ``{name: {'messages': int, 'consumers': int}}``
+        mapping, where the value is :const:`None` if the
+        queue does not exist.
+
+        The numbers are cached for ``CYME_QUEUE_DEPTH_TTL`` seconds,
+        and the queues not cached are declared using a single channel.
+
+        """
+        cache, url = self._depths, broker.url
+        depths, missing = {}, []
+        for name in names:
+            try:
+                depths[name] = cache[(url, name)]
+            except KeyError:
+                missing.append(name)
+        if missing:
+            found = broker.queue_depths(missing)
+            for name in missing:
+                depths[name] = cache[(url, name)] = found.get(name)
+        return depths
 queues = Queue()
 
 
@@ -399,6 +615,10 @@ class Controller(AwareAgent, gThread):
             signals.thread_shutdown_step.send(sender=self)
         super(Controller, self).stop()
 
+    @cached_property
+    def presence(self):
+        return Presence(self, on_awake=self.on_awake)
+
     @property
     def logger_name(self):
         return '#'.join([self.__class__.__name__, self._shortid()])
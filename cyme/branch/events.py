@@ -0,0 +1,173 @@
+"""cyme.branch.events
+
+- Delivers the task events sent by the instances to the requests
+  waiting for tasks, so that they can be notified when the state
+  of a task changes, instead of polling the result backend.
+
+- The events are received by the event consumers of
+  :class:`~cyme.branch.heartbeats.Heartbeats`, so there is only one
+  event consumer per broker, which only receives the task events
+  while there are subscribers for tasks sent to that broker.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+from collections import defaultdict
+
+from celery import states
+from celery.local import Proxy
+from eventlet import Timeout
+from eventlet.event import Event
+from eventlet.queue import LightQueue
+
+__current = None
+
+#: Maps task event types to the state of the task.
+EVENT_STATES = {'task-sent': states.PENDING,
+                'task-received': states.RECEIVED,
+                'task-started': states.STARTED,
+                'task-succeeded': states.SUCCESS,
+                'task-failed': states.FAILURE,
+                'task-retried': states.RETRY,
+                'task-revoked': states.REVOKED}
+
+#: Put in the queues of the subscribers when the event consumer
+#: starts receiving task events again, as events may have been lost
+#: while not receiving them.
+RECONNECTED = {'type': 'reconnected', 'uuid': None, 'state': None}
+
+
+class TaskEventConsumer(object):
+    """Delivers the task events received from one broker
+    to the subscribers of the task."""
+
+    def __init__(self, url):
+        self.url = url
+        self.subscribers = defaultdict(set)
+        self.is_ready = False
+        self._ready = Event()
+
+    def subscribe(self, uuids):
+        """Subscribe to the events of the tasks in ``uuids``.
+
+        Returns a queue receiving the events, which are dicts with the
+        event fields and the new ``state`` of the task, or
+        :data:`RECONNECTED` if events may have been lost.  The queue
+        must be released using :meth:`unsubscribe`.
+
+        """
+        queue = LightQueue()
+        for uuid in uuids:
+            self.subscribers[uuid].add(queue)
+        return queue
+
+    def unsubscribe(self, uuids, queue):
+        for uuid in uuids:
+            subscribers = self.subscribers.get(uuid)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    self.subscribers.pop(uuid, None)
+
+    def wait_ready(self, timeout=None):
+        """Wait for the event consumer to be ready, returns
+        :const:`False` if not ready within ``timeout`` seconds."""
+        if not self.is_ready:
+            with Timeout(timeout, False):
+                self._ready.wait()
+        return self.is_ready
+
+    def on_event(self, event):
+        state = EVENT_STATES.get(event.get('type'))
+        subscribers = self.subscribers.get(event.get('uuid'))
+        if state and subscribers:
+            event = dict(event, state=state)
+            for queue in list(subscribers):
+                queue.put(event)
+
+    def on_consume_ready(self):
+        self.is_ready = True
+        if not self._ready.ready():
+            self._ready.send(True)
+        for queue in set(q for qs in self.subscribers.values() for q in qs):
+            queue.put(RECONNECTED)
+
+    def on_connection_lost(self):
+        self.is_ready = False
+        if self._ready.ready():
+            self._ready = Event()
+
+
+class TaskEvents(object):
+    """Keeps one :class:`TaskEventConsumer` for every broker
+    tasks are waited for.
+
+    :param consume: Function called with the URL of a broker to
+        start consuming events from it.  The consumer must bind the
+        task events while :meth:`wanted` is true for the broker, and
+        call :meth:`on_bound`/:meth:`on_unbound` as they are
+        bound/unbound.
+
+    """
+    Consumer = TaskEventConsumer
+
+    def __init__(self, consume, set_as_current=True):
+        if set_as_current:
+            set_current(self)
+        self.consume = consume
+        self.consumers = {}
+
+    def get(self, url):
+        """Returns the task event consumer for broker ``url``."""
+        try:
+            return self.consumers[url]
+        except KeyError:
+            consumer = self.consumers[url] = self.Consumer(url)
+            self.consume(url)
+            return consumer
+
+    def wanted(self, url):
+        """Returns true if there are subscribers for the
+        tasks sent to broker ``url``."""
+        consumer = self.consumers.get(url)
+        return consumer is not None and bool(consumer.subscribers)
+
+    def on_event(self, url, event):
+        consumer = self.consumers.get(url)
+        if consumer is not None:
+            consumer.on_event(event)
+
+    def on_bound(self, url):
+        """Called when task events are received from ``url``."""
+        consumer = self.consumers.get(url)
+        if consumer is not None:
+            consumer.on_consume_ready()
+
+    def on_unbound(self, url):
+        """Called when task events are no longer received from ``url``
+        (no subscribers, or the connection was lost)."""
+        consumer = self.consumers.get(url)
+        if consumer is not None:
+            consumer.on_connection_lost()
+
+
+class _OfflineTaskEvents(object):
+
+    def get(self, url):
+        pass
+
+
+def set_current(task_events):
+    global __current
+    __current = task_events
+    return __current
+
+
+def get_current():
+    if __current is None:
+        return _OfflineTaskEvents()
+    return __current
+
+task_events = Proxy(get_current)
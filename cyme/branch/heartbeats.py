@@ -0,0 +1,176 @@
+"""cyme.branch.heartbeats
+
+- Consumes the events sent by the worker instances, to keep track
+  of when an instance was last seen.
+
+- Used by the supervisor to consider instances that recently sent
+  a heartbeat as alive, so that only silent instances has to be pinged.
+
+- The same consumers also receive the task events of a broker while
+  there are requests waiting for tasks sent to it, and deliver them
+  to the waiting requests (see :mod:`cyme.branch.events`).
+
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import socket
+
+from functools import partial
+from time import sleep, time
+
+from celery import current_app as celery
+from celery.local import Proxy
+
+from .events import TaskEvents
+from .signals import heartbeats_ready
+from .thread import gThread
+
+from cyme import conf
+from cyme.models import Broker
+
+__current = None
+
+
+class Heartbeats(gThread):
+    """Consumes ``worker-online``, ``worker-heartbeat`` and
+    ``worker-offline`` events from all the brokers used by instances
+    on this branch, and the task events from the brokers tasks are
+    waited for (see :attr:`task_events`).
+
+    :keyword expires: Max number of seconds since the last event
+        was received from an instance for it to be considered alive
+        (default is the ``CYME_HEARTBEAT_EXPIRES`` setting).
+
+    """
+    Brokers = Broker._default_manager
+
+    #: Interval (in seconds as an int/float) between checking
+    #: for new brokers to consume events from.
+    interval = 30.0
+
+    #: Time in seconds to wait before reconnecting after
+    #: a connection error.
+    retry_interval = 5.0
+
+    #: Max number of seconds since the last event.
+    expires = None
+
+    #: Max time in seconds to wait for events before checking
+    #: if the task events of a broker are wanted.
+    drain_timeout = 0.5
+
+    def __init__(self, expires=None, set_as_current=True):
+        self.expires = expires or self.expires or conf.CYME_HEARTBEAT_EXPIRES
+        if set_as_current:
+            set_current(self)
+        self.last_seen = {}
+        self._consumers = {}
+        self.task_events = TaskEvents(self.consume,
+                                      set_as_current=set_as_current)
+        super(Heartbeats, self).__init__()
+
+    def is_alive(self, hostname):
+        """Returns :const:`True` if an event was received from
+        the instance with this hostname within :attr:`expires` seconds."""
+        try:
+            return time() - self.last_seen[hostname] < self.expires
+        except KeyError:
+            return False
+
+    def on_worker_alive(self, event):
+        # the local time is used, so clock skew between hosts
+        # doesn't matter.
+        self.last_seen[event['hostname']] = time()
+
+    def on_worker_offline(self, event):
+        self.last_seen.pop(event['hostname'], None)
+
+    def before(self):
+        self.start_periodic_timer(self.interval, self.consume_all)
+
+    def run(self):
+        self.consume_all()
+        self.info('started')
+        heartbeats_ready.send(sender=self)
+        while not self.should_stop:
+            self.respond_to_ping()
+            sleep(1.0)
+
+    def after(self):
+        for g in self._consumers.itervalues():
+            g.kill()
+
+    def consume_all(self):
+        """Start consuming events from brokers not already
+        being consumed from."""
+        for url in self.Brokers.values_list('url', flat=True):
+            self.consume(url)
+
+    def consume(self, url):
+        """Start consuming events from broker ``url``,
+        if not already being consumed from."""
+        if url not in self._consumers:
+            self._consumers[url] = self.spawn(self._consume, url)
+
+    def _consume(self, url):
+        while not self.should_stop:
+            try:
+                with celery.broker_connection(url) as conn:
+                    self.debug('consuming events from %s', conn.as_uri())
+                    receiver = self.Receiver(conn, url)
+                    with receiver.consumer(wakeup=False) as consumer:
+                        queue, bound = consumer.queues[0], False
+                        while not self.should_stop:
+                            bound = self._bind_task_events(url, queue, bound)
+                            try:
+                                conn.drain_events(timeout=self.drain_timeout)
+                            except socket.timeout:
+                                pass
+            except Exception, exc:
+                self.task_events.on_unbound(url)
+                self.error('Event consumer for %s raised: %r', url, exc)
+                sleep(self.retry_interval)
+
+    def Receiver(self, conn, url):
+        """Returns the event receiver for broker ``url``, which only
+        receives the worker events until task events are wanted."""
+        return celery.events.Receiver(conn,
+                    handlers={'worker-online': self.on_worker_alive,
+                              'worker-heartbeat': self.on_worker_alive,
+                              'worker-offline': self.on_worker_offline,
+                              '*': partial(self.task_events.on_event, url)},
+                    routing_key='worker.#')
+
+    def _bind_task_events(self, url, queue, bound):
+        # the task events of a broker are only received while
+        # there are requests waiting for tasks sent to it.
+        wanted = self.task_events.wanted(url)
+        if wanted and not bound:
+            queue.bind_to(queue.exchange, routing_key='task.#')
+            self.task_events.on_bound(url)
+        elif bound and not wanted:
+            self.task_events.on_unbound(url)
+            queue.unbind_from(queue.exchange, routing_key='task.#')
+        return wanted
+
+
+class _OfflineHeartbeats(object):
+
+    def is_alive(self, hostname):
+        return False
+
+
+def set_current(hb):
+    global __current
+    __current = hb
+    return __current
+
+
+def get_current():
+    if __current is None:
+        return _OfflineHeartbeats()
+    return __current
+
+heartbeats = Proxy(get_current)
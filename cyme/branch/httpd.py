@@ -16,10 +16,16 @@ from requests import get
 from .thread import gThread
 from .signals import httpd_ready
 
+from cyme.utils import instantiate
+
 
 class HttpServer(gThread):
     joinable = False
 
+    #: WSGI application handling task requests and ping without
+    #: going through Django (set to :const:`None` to disable).
+    fastpath_cls = 'cyme.api.fastpath.FastPath'
+
     def __init__(self, addrport=None):
         host, port = addrport or ('', 8000)
         if host == 'localhost':
@@ -35,6 +41,8 @@ class HttpServer(gThread):
 
     def run(self):
         handler = AdminMediaHandler(djwsgi.WSGIHandler())
+        if self.fastpath_cls:
+            handler = instantiate(self, self.fastpath_cls, handler)
         sock = listen(self.addrport)
         g = self.spawn(self.server, sock, handler)
         self.info('ready')
@@ -0,0 +1,127 @@
+"""cyme.branch.placement
+
+- Placement policies deciding which branch a new instance is added to.
+
+- The policies select from the load reported by every branch
+  (see :meth:`cyme.branch.controller.Instance.place`), which is a
+  dict with the fields:
+
+    * ``id``: Id of the agent.
+    * ``load_average``: 1/5/15 minute load average.
+    * ``cpus``: Number of CPUs.
+    * ``disk_use``: Disk use of the instance directory, in percent.
+    * ``instances``: Number of enabled instances.
+    * ``processes``: Sum of the ``max_concurrency`` of the
+      enabled instances.
+
+- The policy used is selected by the ``CYME_PLACEMENT_POLICY`` setting.
+
+"""
+
+from __future__ import absolute_import
+
+from celery.utils import get_cls_by_name
+
+#: Placement policy aliases that can be used with the
+#: ``CYME_PLACEMENT_POLICY`` setting.  The ``round-robin`` policy
+#: sends the request to whichever branch picks it up first.
+POLICIES = {'least-loaded': 'cyme.branch.placement.LeastLoaded',
+            'bin-packing': 'cyme.branch.placement.BinPacking',
+            'spread': 'cyme.branch.placement.Spread',
+            'round-robin': None}
+
+
+class Policy(object):
+    """Base class for placement policies.
+
+    :keyword max_disk_use: Branches with a disk use (in percent)
+        above this are only selected if there are no other branches.
+
+    """
+
+    #: Default max disk use in percent.
+    max_disk_use = 95
+
+    def __init__(self, max_disk_use=None):
+        self.max_disk_use = max_disk_use or self.max_disk_use
+
+    def select(self, branches, spec):
+        """Returns the id of the agent that should run an instance
+        with the arguments in ``spec``, or :const:`None` if no branches
+        are available."""
+        branches = self.eligible(branches)
+        if branches:
+            return self.choose(branches, spec)['id']
+
+    def choose(self, branches, spec):
+        raise NotImplementedError('Policies must implement choose')
+
+    def eligible(self, branches):
+        return [b for b in branches
+                    if b['disk_use'] <= self.max_disk_use] or branches
+
+    def least_loaded(self, branches):
+        return min(branches, key=lambda b: (self.load(b), b['processes']))
+
+    def load(self, branch):
+        return branch['load_average'][0] / (branch.get('cpus') or 1)
+
+    def processes(self, spec):
+        return int(spec.get('max_concurrency') or 1)
+
+
+class LeastLoaded(Policy):
+    """Select the branch with the lowest load average per CPU,
+    using the number of processes as a tie-breaker."""
+
+    def choose(self, branches, spec):
+        return self.least_loaded(branches)
+
+
+class Spread(Policy):
+    """Select the branch with the least instances, so the instances
+    are spread evenly across the branches."""
+
+    def choose(self, branches, spec):
+        return min(branches, key=lambda b: (b['instances'], b['processes']))
+
+
+class BinPacking(Policy):
+    """Select the branch with the most processes that still has room
+    for the instance, so that the branches are filled one at a time.
+
+    :keyword capacity: Max number of processes per CPU on a branch.
+        If none of the branches have room the least loaded
+        branch is selected.
+
+    """
+
+    #: Default max number of processes per CPU.
+    capacity = 4
+
+    def __init__(self, capacity=None, **kwargs):
+        self.capacity = capacity or self.capacity
+        super(BinPacking, self).__init__(**kwargs)
+
+    def choose(self, branches, spec):
+        needed = self.processes(spec)
+        fits = [b for b in branches
+                    if b['processes'] + needed <=
+                        self.capacity * (b.get('cpus') or 1)]
+        if fits:
+            return max(fits, key=lambda b: (b['processes'], -self.load(b)))
+        return self.least_loaded(branches)
+
+
+def get_policy(name=None):
+    """Returns a new policy instance by alias or class name, the default
+    is the policy selected by the ``CYME_PLACEMENT_POLICY`` setting.
+
+    Returns :const:`None` for the ``round-robin`` policy.
+
+    """
+    if name is None:
+        from cyme.conf import CYME_PLACEMENT_POLICY as name
+    cls = POLICIES.get(name, name)
+    if cls:
+        return get_cls_by_name(cls)()
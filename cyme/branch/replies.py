@@ -0,0 +1,162 @@
+"""cyme.branch.replies
+
+- Long-lived reply queue used to collect the replies to the
+  remote control commands sent to instances.
+
+- Normally every broadcast with ``reply=True`` declares, consumes from
+  and deletes a new reply queue.  When running as a branch the queries
+  sent by :class:`~cyme.models.Instance` instead share one reply queue
+  and consumer per broker, and replies are correlated by ticket.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+from Queue import Empty
+from time import sleep, time
+
+from celery import current_app as celery
+from celery.local import Proxy
+from eventlet.queue import LightQueue
+from kombu import Consumer, Queue
+from kombu.utils import uuid
+
+from .signals import replies_ready
+from .thread import gThread
+
+__current = None
+
+
+class ReplyConsumer(object):
+    """Consumes replies sent to one broker.
+
+    The reply queue is bound to the reply exchange with one routing key
+    per outstanding ticket, and the replies are delivered to the
+    caller waiting for that ticket.
+
+    """
+
+    #: Time in seconds to wait before reconnecting after
+    #: a connection error.
+    retry_interval = 2.0
+
+    def __init__(self, url, thread):
+        self.url = url
+        self.thread = thread
+        self.pending = {}
+        self.mailbox = celery.control.mailbox
+        self.queue = Queue('cyme.reply.%s' % (uuid(), ),
+                           exchange=self.mailbox.reply_exchange,
+                           routing_key='cyme.reply',
+                           durable=False, auto_delete=True)
+        self.is_ready = False
+        self.g = thread.spawn(self._consume)
+
+    def call(self, cmd, args, destination, connection=None, channel=None,
+            timeout=3, limit=None, **kwargs):
+        """Send remote control command, and collect replies until
+        ``limit`` replies are received (default is one per destination)
+        or the timeout is exceeded."""
+        limit = limit or len(destination)
+        ticket = uuid()
+        replies = self.pending[ticket] = LightQueue()
+        exchange = self.mailbox.reply_exchange.name
+        queue = self.queue(channel)
+        try:
+            queue.bind_to(exchange, ticket)
+            self.mailbox(connection)._publish(cmd, args,
+                                              destination=destination,
+                                              reply_ticket=ticket,
+                                              channel=channel)
+            collected = []
+            deadline = time() + timeout
+            while len(collected) < limit:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                try:
+                    collected.append(replies.get(timeout=remaining))
+                except Empty:
+                    break
+            return collected
+        finally:
+            self.pending.pop(ticket, None)
+            queue.unbind_from(exchange, ticket, nowait=True)
+
+    def on_reply(self, body, message):
+        ticket = message.delivery_info.get('routing_key')
+        try:
+            self.pending[ticket].put(body)
+        except KeyError:
+            pass  # late reply.
+
+    def _consume(self):
+        while not self.thread.should_stop:
+            try:
+                with celery.broker_connection(self.url) as conn:
+                    consumer = Consumer(conn.default_channel, [self.queue],
+                                        callbacks=[self.on_reply],
+                                        no_ack=True)
+                    with consumer:
+                        self.is_ready = True
+                        while not self.thread.should_stop:
+                            conn.drain_events()
+            except Exception, exc:
+                self.is_ready = False
+                self.thread.error('Reply consumer for %s raised: %r',
+                                  self.url, exc)
+                sleep(self.retry_interval)
+
+
+class Replies(gThread):
+    """Keeps one :class:`ReplyConsumer` for every broker
+    queries are sent to."""
+    Consumer = ReplyConsumer
+
+    def __init__(self, set_as_current=True):
+        if set_as_current:
+            set_current(self)
+        self.consumers = {}
+        super(Replies, self).__init__()
+
+    def get(self, url):
+        """Returns the reply consumer for broker ``url``, or
+        :const:`None` if the consumer is not ready yet."""
+        try:
+            consumer = self.consumers[url]
+        except KeyError:
+            consumer = self.consumers[url] = self.Consumer(url, self)
+        if consumer.is_ready:
+            return consumer
+
+    def run(self):
+        self.info('started')
+        replies_ready.send(sender=self)
+        while not self.should_stop:
+            self.respond_to_ping()
+            sleep(1.0)
+
+    def after(self):
+        for consumer in self.consumers.itervalues():
+            consumer.g.kill()
+
+
+class _OfflineReplies(object):
+
+    def get(self, url):
+        pass
+
+
+def set_current(replies):
+    global __current
+    __current = replies
+    return __current
+
+
+def get_current():
+    if __current is None:
+        return _OfflineReplies()
+    return __current
+
+replies = Proxy(get_current)
@@ -0,0 +1,257 @@
+"""cyme.branch.routing
+
+- Local index of the entities owned by every branch.
+
+- The actors publish the names of the entities they own in the
+  presence ``meta`` sections (``instances``, ``queues``, etc.), and the
+  index is kept up to date from the presence events received, so that
+  the owner of an entity can be found without broadcasting
+  to all branches.
+
+- To keep the presence events small the names are published using
+  :class:`VersionedMeta`:  a full snapshot is only sent at intervals
+  (or when another agent wakes up), and other than that the events
+  only contain the names added/removed since the last event.
+
+"""
+
+from __future__ import absolute_import
+
+from collections import defaultdict
+from time import time
+
+from cell import presence
+from kombu.utils import uuid
+
+
+class VersionedMeta(object):
+    """Presence meta for an actor, sent as a versioned snapshot
+    followed by deltas.
+
+    :param section: Name of the meta section.
+    :param fetch: Function returning the current values of the section.
+    :keyword snapshot_interval: Interval (in seconds as a float)
+        between full snapshots.
+
+    A snapshot::
+
+        {'epoch': 'uuid', 'version': 3, 'instances': ['a', 'b']}
+
+    and a delta::
+
+        {'epoch': 'uuid', 'version': 4, 'since': 3,
+         'added': {'instances': ['c']}, 'removed': {'instances': ['a']}}
+
+    A delta with the same ``version`` and ``since`` means nothing
+    changed.
+
+    """
+
+    #: Default interval between full snapshots.
+    snapshot_interval = 120.0
+
+    def __init__(self, section, fetch, snapshot_interval=None):
+        self.section = section
+        self.fetch = fetch
+        self.snapshot_interval = snapshot_interval or self.snapshot_interval
+        self.epoch = uuid()
+        self.version = 0
+        self.announced = None
+        self.last_snapshot = None
+        self.dirty = False
+
+    def changed(self):
+        """Mark the values as changed, so that the next event
+        includes a delta."""
+        self.dirty = True
+
+    def __call__(self, snapshot=False):
+        if snapshot or self.announced is None or \
+                time() - self.last_snapshot > self.snapshot_interval:
+            return self.snapshot()
+        if self.dirty:
+            return self.delta()
+        return self._header(since=self.version)
+
+    def snapshot(self):
+        values = self._fetch()
+        if values != self.announced:
+            self.version += 1
+            self.announced = values
+        self.last_snapshot = time()
+        return self._header(**{self.section: list(values)})
+
+    def delta(self):
+        values = self._fetch()
+        since = self.version
+        added, removed = values - self.announced, self.announced - values
+        if added or removed:
+            self.version += 1
+            self.announced = values
+        return self._header(since=since,
+                            added={self.section: list(added)},
+                            removed={self.section: list(removed)})
+
+    def _fetch(self):
+        self.dirty = False
+        return set(self.fetch())
+
+    def _header(self, **fields):
+        return dict(fields, epoch=self.epoch, version=self.version)
+
+
+class RoutingIndex(object):
+    """Maps the values in the presence meta sections to
+    the agents owning them."""
+
+    def __init__(self):
+        # (actor, section) -> {value: agent}
+        self.owners = defaultdict(dict)
+        # agent -> {(actor, section): set of values}
+        self.owned = {}
+        # (agent, actor) -> (epoch, version) of the values indexed,
+        # or None if not versioned.
+        self.versions = {}
+
+    def update(self, agent, meta):
+        """Update the entries owned by ``agent`` from its
+        presence ``meta``."""
+        for actor, sections in (meta or {}).iteritems():
+            if sections is None:
+                continue
+            if 'since' in sections:
+                self._apply_delta(agent, actor, sections)
+            else:
+                self._replace(agent, actor, sections)
+
+    def remove(self, agent):
+        """Remove all entries owned by ``agent``."""
+        for key, values in (self.owned.pop(agent, None) or {}).iteritems():
+            self._discard(agent, key, values)
+        for key in [key for key in self.versions if key[0] == agent]:
+            del self.versions[key]
+
+    def owner(self, actor, section, value):
+        """Returns the agent owning ``value``, or :const:`None`
+        if not known."""
+        return self.owners[(actor, section)].get(value)
+
+    def values(self, actor, section):
+        """Returns all the values in a section across all agents."""
+        return self.owners[(actor, section)].keys()
+
+    def indexes(self, agent, actor):
+        """Returns true if the entries of ``actor`` for ``agent``
+        are in the index, and up to date."""
+        return (agent, actor) in self.versions
+
+    def _replace(self, agent, actor, sections):
+        version = None
+        if 'version' in sections:
+            sections = dict(sections)
+            version = (sections.pop('epoch'), sections.pop('version'))
+        owned = self.owned.setdefault(agent, {})
+        for key in [key for key in owned if key[0] == actor]:
+            self._discard(agent, key, owned.pop(key))
+        for section, values in sections.iteritems():
+            self._add(agent, (actor, section), values)
+        self.versions[(agent, actor)] = version
+
+    def _apply_delta(self, agent, actor, delta):
+        version = (delta['epoch'], delta['version'])
+        known = self.versions.get((agent, actor))
+        if known == version:
+            return
+        if known != (delta['epoch'], delta['since']):
+            # missed a delta, so the entries are out of date
+            # until the next snapshot is received.
+            self.versions.pop((agent, actor), None)
+            return
+        owned = self.owned.setdefault(agent, {})
+        for section, values in (delta.get('removed') or {}).iteritems():
+            values = set(values) & owned.get((actor, section), set())
+            self._discard(agent, (actor, section), values)
+        for section, values in (delta.get('added') or {}).iteritems():
+            self._add(agent, (actor, section), values)
+        self.versions[(agent, actor)] = version
+
+    def _add(self, agent, key, values):
+        values = set(values or ())
+        self.owned.setdefault(agent, {}).setdefault(key, set()).update(values)
+        owners = self.owners[key]
+        for value in values:
+            owners[value] = agent
+
+    def _discard(self, agent, key, values):
+        owned = self.owned.get(agent, {}).get(key)
+        if owned is not None:
+            owned.difference_update(values)
+        owners = self.owners[key]
+        for value in values:
+            if owners.get(value) == agent:
+                del owners[value]
+
+
+class State(presence.State):
+    """Presence state keeping a :class:`RoutingIndex`."""
+
+    def __init__(self, *args, **kwargs):
+        self.routes = RoutingIndex()
+        super(State, self).__init__(*args, **kwargs)
+
+    def update_meta_for(self, agent, meta):
+        super(State, self).update_meta_for(agent, meta)
+        self.routes.update(agent, meta)
+
+    def _remove_agent(self, agent):
+        super(State, self)._remove_agent(agent)
+        self.routes.remove(agent)
+
+    def when_wakeup(self, **kw):
+        # the agent waking up needs a full snapshot from everyone.
+        self.presence.snapshot_next = True
+        super(State, self).when_wakeup(**kw)
+
+    def owner(self, actor, section, value):
+        """Returns the live agent owning ``value``, or :const:`None`."""
+        agent = self.routes.owner(actor, section, value)
+        if agent is not None and agent in self.agents_with(actor):
+            return agent
+
+    def agents_with(self, actor):
+        return set(id for id, state in self.agents.iteritems()
+                        if state and actor in (state.get('actors') or ()))
+
+    def is_complete(self, actor):
+        """Returns true if the index includes the up to date entries
+        of ``actor`` for all live agents."""
+        agents = self.agents_with(actor)
+        return bool(agents) and all(self.routes.indexes(agent, actor)
+                                        for agent in agents)
+
+    def values_for(self, actor, section):
+        """Returns all values in ``section`` across the live agents,
+        or :const:`None` if the index does not include all of them yet."""
+        if self.is_complete(actor):
+            return self.routes.values(actor, section)
+
+
+class Presence(presence.Presence):
+    """Presence sending the meta of actors with a
+    ``presence_meta`` method as snapshots and deltas."""
+    State = State
+
+    #: Set if the next event must include full snapshots.
+    snapshot_next = False
+
+    def meta(self):
+        snapshot, self.snapshot_next = self.snapshot_next, False
+        return dict((actor.name, self._actor_meta(actor, snapshot))
+                        for actor in self.agent.actors)
+
+    def _actor_meta(self, actor, snapshot=False):
+        try:
+            get_meta = actor.presence_meta
+        except AttributeError:
+            return actor.meta
+        return get_meta(snapshot=snapshot)
@@ -19,6 +19,30 @@ httpd_ready = Signal(providing_args=['addrport', 'handler', 'sock'])
 #:     :sender: is the :class:`~cyme.supervisor.Supervisor` instance.
 supervisor_ready = Signal()
 
+#: Sent when the heartbeat monitor is ready.
+#: Arguments:
+#:
+#:     :sender: is the :class:`~cyme.branch.heartbeats.Heartbeats` instance.
+heartbeats_ready = Signal()
+
+#: Sent when the reply consumer thread is ready.
+#: Arguments:
+#:
+#:     :sender: is the :class:`~cyme.branch.replies.Replies` instance.
+replies_ready = Signal()
+
+#: Sent when the autoscaler is ready.
+#: Arguments:
+#:
+#:     :sender: is the :class:`~cyme.branch.autoscaler.Autoscaler` instance.
+autoscaler_ready = Signal()
+
+#: Sent when the confirm publisher thread is ready.
+#: Arguments:
+#:
+#:     :sender: is the :class:`~cyme.branch.confirms.Confirms` instance.
+confirms_ready = Signal()
+
 #: Sent when a controller is ready.
 #:
 #: Arguments:
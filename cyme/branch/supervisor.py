@@ -3,20 +3,96 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+from collections import OrderedDict
+from functools import partial
+from itertools import count
 from threading import Lock
+from time import time
 from Queue import Empty
 
 from celery.local import Proxy
-from eventlet.queue import LightQueue
+from eventlet import GreenPool
+from eventlet.queue import PriorityQueue
 from eventlet.event import Event
+from eventlet.semaphore import Semaphore
 
+from .heartbeats import heartbeats
 from .signals import supervisor_ready
 from .thread import gThread
 
+from cyme import conf
 from cyme.status import Status
+from cyme.utils import DummyLock
 
 __current = None
 
+#: Priority of requests made by users (API, admin, etc.).
+PRIORITY_INTERACTIVE = 0
+
+#: Priority of the periodic verification sweeps.
+PRIORITY_PERIODIC = 9
+
+
+class Request(object):
+    """A request made to the supervisor, the :attr:`event` is sent
+    when the action has been applied to all of the instances.
+
+    :keyword probe: Function returning a snapshot of the state of
+        the instances, passed to the action as the ``snapshot``
+        keyword argument.  The snapshot is taken when the first job
+        of the request runs, and taken again if it is older than
+        :attr:`snapshot_max_age` seconds.
+
+    """
+
+    #: Max age (in seconds as a float) of the snapshot used by a job.
+    snapshot_max_age = 5.0
+
+    _snapshot = None
+    _snapshot_at = None
+
+    def __init__(self, action, kwargs, priority=PRIORITY_INTERACTIVE,
+            merge=False, probe=None):
+        self.action = action
+        self.kwargs = kwargs
+        self.priority = priority
+        self.merge = merge
+        self.probe = probe
+        self.event = Event()
+        self._probe_mutex = Semaphore()
+
+    def get_kwargs(self):
+        """Returns the keyword arguments to apply the action with."""
+        if self.probe is None:
+            return self.kwargs
+        with self._probe_mutex:
+            if self._snapshot_at is None or \
+                    time() - self._snapshot_at > self.snapshot_max_age:
+                self._snapshot = self.probe()
+                self._snapshot_at = time()
+        if self._snapshot is None:
+            return self.kwargs
+        return dict(self.kwargs, snapshot=self._snapshot)
+
+
+class Job(object):
+    """The part of a request operating on a single instance."""
+
+    #: Event sent by the job for the same instance dispatched before this.
+    after = None
+
+    #: Set if the job was merged into a job with higher priority.
+    cancelled = False
+
+    def __init__(self, instance, request, priority=None, seq=None):
+        self.instance = instance
+        self.request = request
+        self.name = instance.name
+        self.priority = (priority if priority is not None
+                                  else request.priority)
+        self.seq = seq
+        self.done = Event()
+
 
 class Supervisor(gThread, Status):
     """The supervisor wakes up at intervals to monitor changes in the model.
@@ -27,6 +103,11 @@ class Supervisor(gThread, Status):
        between verifying all the registered instances.
     :keyword queue: Custom :class:`~Queue.Queue` instance used to send
         and receive commands.
+    :keyword concurrency: Max number of instances to operate on
+        concurrently (default is the ``CYME_SUP_CONCURRENCY`` setting).
+    :keyword max_restarts: Max number of instances to restart
+        concurrently (default is the ``CYME_SUP_MAX_RESTARTS`` setting,
+        or no limit other than :attr:`concurrency`).
 
     It is responsible for:
 
@@ -41,6 +122,20 @@ class Supervisor(gThread, Status):
           model,  sending ``autoscale`` broadcast commands to the noes
           as it finds inconsistencies.
 
+    Requests are split into one job per instance, and the jobs are
+    scheduled by priority, so that requests made by users are handled
+    before the remaining instances of a periodic sweep.
+    Jobs for the same instance are always applied in the order they
+    were requested, so a job with a higher priority also raises the
+    priority of the jobs requested before it for that instance.
+    A verify request for an instance that already has a pending
+    verify job with the same arguments is merged into that job.
+
+    The periodic sweep only verifies the instances that changed since
+    they were last verified, failed verification or stopped sending
+    heartbeats, and all instances are only verified every
+    :attr:`audit_interval` seconds.
+
     The supervisor is resilient to intermittent connection failures,
     and will auto-retry any operation that is dependent on a broker.
 
@@ -63,20 +158,52 @@ class Supervisor(gThread, Status):
     #: Default interval (time in seconds as a float to reschedule).
     interval = 60.0
 
-    def __init__(self, interval=None, queue=None, set_as_current=True):
+    #: Max number of instances operated on concurrently.
+    #: Jobs are processed by a green pool of this size, so
+    #: slow/unresponsive instances does not hold up the rest of the sweep.
+    concurrency = None
+
+    #: Max number of instances restarted concurrently.
+    max_restarts = None
+
+    #: Interval (time in seconds as a float) between periodic sweeps
+    #: verifying all instances, not just the ones changed.
+    audit_interval = 600.0
+
+    def __init__(self, interval=None, queue=None, set_as_current=True,
+            concurrency=None, max_restarts=None):
         self.set_as_current = set_as_current
         if self.set_as_current:
             set_current(self)
         self._orig_queue_arg = queue
         self.interval = interval or self.interval
-        self.queue = LightQueue() if queue is None else queue
+        self.concurrency = (concurrency or self.concurrency
+                                        or conf.CYME_SUP_CONCURRENCY)
+        self.max_restarts = (max_restarts or self.max_restarts
+                                          or conf.CYME_SUP_MAX_RESTARTS)
+        self.queue = PriorityQueue() if queue is None else queue
+        self.pool = GreenPool(self.concurrency)
+        self._restart_limit = (Semaphore(self.max_restarts)
+                                    if self.max_restarts else DummyLock())
+        self._seq = count()
+        # instance name -> verify job not yet dispatched.
+        self._pending_verify = {}
+        # instance name -> list of jobs not yet dispatched.
+        self._queued = {}
+        # instance name -> last job dispatched.
+        self._tails = {}
         self._pause_mutex = Lock()
         self._last_update = None
+        self._last_audit = None
+        # instance name -> model version last verified successfully.
+        self._verified = {}
         gThread.__init__(self)
         Status.__init__(self)
 
     def __copy__(self):
-        return self.__class__(self.interval, self._orig_queue_arg)
+        return self.__class__(self.interval, self._orig_queue_arg,
+                              concurrency=self.concurrency,
+                              max_restarts=self.max_restarts)
 
     def pause(self):
         """Pause all timers."""
@@ -93,17 +220,21 @@ class Supervisor(gThread, Status):
                 self.debug('resuming')
                 self.paused = False
 
-    def verify(self, instances, ratelimit=False):
+    def verify(self, instances, ratelimit=False,
+            priority=PRIORITY_INTERACTIVE):
         """Verify the consistency of one or more instances.
 
         :param instances: List of instances to verify.
+        :keyword priority: Priority of the request, lower is
+            more important.
 
         This operation is asynchronous, and returns a :class:`Greenlet`
         instance that can be used to wait for the operation to complete.
 
         """
         return self._request(instances, self._do_verify_instance,
-                            {'ratelimit': ratelimit})
+                            {'ratelimit': ratelimit}, probe=True,
+                            priority=priority, merge=True)
 
     def restart(self, instances):
         """Restart one or more instances.
@@ -133,10 +264,89 @@ class Supervisor(gThread, Status):
         """
         return self._request(instances, self._do_stop_instance)
 
-    def _request(self, instances, action, kwargs={}):
-        event = Event()
-        self.queue.put_nowait((instances, event, action, kwargs))
-        return event
+    def _request(self, instances, action, kwargs={}, probe=False,
+            priority=PRIORITY_INTERACTIVE, merge=False):
+        # an instance is only included once, using the last version given,
+        # in the order the instances were given.
+        unique = OrderedDict()
+        for instance in instances:
+            unique[instance.name] = instance
+        unique = unique.values()
+        request = Request(action, kwargs, priority, merge,
+                          probe=(partial(self._probe, unique)
+                                    if probe and len(unique) > 1 else None))
+        self._schedule(request, unique)
+        return request.event
+
+    def _probe(self, instances):
+        # one broadcast per command for all of the instances,
+        # so only the ones not replying has to be queried individually.
+        if self.paused:
+            return
+        try:
+            return self.snapshot(instances)
+        except Exception, exc:
+            self.error('Snapshot caused exception: %r', exc)
+
+    def _schedule(self, request, instances):
+        waiting = []
+        pending = self._pending_verify
+        for instance in instances:
+            other = pending.get(instance.name) if request.merge else None
+            if other is not None and other.request.kwargs != request.kwargs:
+                other = None  # can only merge jobs doing the same thing.
+            if other is not None and other.priority <= request.priority:
+                # the pending job will verify this instance before
+                # this request would, but using the latest version.
+                other.instance = instance
+                waiting.append(other.done)
+                continue
+            job = Job(instance, request, seq=next(self._seq))
+            if other is not None:
+                # the pending job is superseded by this request.
+                self._cancel(other, job)
+            if request.merge:
+                pending[job.name] = job
+            self._promote(job.name, job.priority)
+            self._enqueue(job)
+            waiting.append(job.done)
+        self.spawn(self._complete, request, waiting)
+
+    def _enqueue(self, job):
+        self._queued.setdefault(job.name, []).append(job)
+        self.queue.put_nowait((job.priority, job.seq, job))
+
+    def _cancel(self, job, replacement):
+        job.cancelled = True
+        self._unqueue(job)
+        self.spawn(self._forward, replacement, job)
+
+    def _unqueue(self, job):
+        queued = self._queued.get(job.name)
+        if queued and job in queued:
+            queued.remove(job)
+            if not queued:
+                del self._queued[job.name]
+
+    def _promote(self, name, priority):
+        # requeue the jobs requested earlier for this instance with
+        # a lower priority, keeping their place in the order.
+        for job in list(self._queued.get(name, ())):
+            if job.priority > priority:
+                promoted = Job(job.instance, job.request, priority, job.seq)
+                if self._pending_verify.get(name) is job:
+                    self._pending_verify[name] = promoted
+                self._cancel(job, promoted)
+                self._enqueue(promoted)
+
+    def _forward(self, job, cancelled):
+        job.done.wait()
+        cancelled.done.send(True)
+
+    def _complete(self, request, waiting):
+        for done in waiting:
+            done.wait()
+        request.event.send(True)
 
     def before(self):
         self.start_periodic_timer(self.interval, self._verify_all)
@@ -147,20 +357,80 @@ class Supervisor(gThread, Status):
         supervisor_ready.send(sender=self)
         while not self.should_stop:
             try:
-                instances, event, action, kwargs = queue.get(timeout=1)
+                _, _, job = queue.get(timeout=1)
             except Empty:
                 self.respond_to_ping()
                 continue
             self.respond_to_ping()
-            self.debug('wake-up')
-            try:
-                for instance in instances:
-                    try:
-                        action(instance, **kwargs)
-                    except Exception, exc:
-                        self.error('Event caused exception: %r', exc)
-            finally:
-                event.send(True)
+            if self._dispatch(job):
+                self.pool.spawn(self._run_job, job)  # waits for free slot.
+
+    def _dispatch(self, job):
+        """Prepare job taken from the queue to be run, returns
+        :const:`False` if the job was cancelled."""
+        if self._pending_verify.get(job.name) is job:
+            del self._pending_verify[job.name]
+        if job.cancelled:
+            return False
+        self._unqueue(job)
+        self.debug('wake-up')
+        # jobs for the same instance are chained, so that two
+        # actions on the same instance never overlap.
+        previous = self._tails.get(job.name)
+        if previous is not None:
+            job.after = previous.done
+        self._tails[job.name] = job
+        return True
+
+    def _run_job(self, job):
+        try:
+            if job.after is not None:
+                job.after.wait()
+            self._apply(job.instance, job.request.action,
+                        job.request.get_kwargs())
+        finally:
+            if self._tails.get(job.name) is job:
+                del self._tails[job.name]
+            job.done.send(True)
+
+    def _verify_restart_instance(self, instance):
+        with self._restart_limit:
+            return Status._verify_restart_instance(self, instance)
+
+    def _apply(self, instance, action, kwargs):
+        try:
+            action(instance, **kwargs)
+        except Exception, exc:
+            self._verified.pop(instance.name, None)
+            self.error('Event caused exception: %r', exc)
+        else:
+            if action == self._do_verify_instance and not self.paused:
+                self._verified[instance.name] = instance.version
+            else:
+                self._verified.pop(instance.name, None)
+
+    def dirty_instances(self):
+        """Returns the instances the next periodic sweep must verify.
+
+        This is the instances changed since last verified, the
+        ones that failed verification, and the enabled instances not
+        recently sending heartbeats; or all instances if
+        :attr:`audit_interval` has passed since the last full audit.
+
+        """
+        instances = list(self.all_instances())
+        verified = self._verified
+        for name in set(verified) - set(i.name for i in instances):
+            verified.pop(name, None)  # removed instance.
+        now = time()
+        if self._last_audit is None or \
+                now - self._last_audit > self.audit_interval:
+            self._last_audit = now
+            return instances
+        return [instance for instance in instances
+                    if verified.get(instance.name) != instance.version
+                        or (instance.is_enabled and
+                                not heartbeats.is_alive(instance.name))]
 
     def _verify_all(self, force=False):
         if self._last_update and self._last_update.ready():
@@ -170,8 +440,9 @@ class Supervisor(gThread, Status):
                 pass
             force = True
         if not self._last_update or force:
-            self._last_update = self.verify(self.all_instances(),
-                                            ratelimit=True)
+            self._last_update = self.verify(self.dirty_instances(),
+                                            ratelimit=True,
+                                            priority=PRIORITY_PERIODIC)
 
 
 class _OfflineSupervisor(object):
@@ -13,6 +13,47 @@ Branches
    {'sup_interval': 5, 'numc': 2, 'loglevel': 'INFO',
     'logfile': None, 'id': 'cyme1.example.com', 'port': 8000}
 
+Connections
+~~~~~~~~~~~
+
+The client keeps connections alive between requests.  The app clients
+returned by the client, and the instances and queues sections, all share
+the same connection pool.
+
+    >>> client = Client('http://localhost:8000', pool_size=20, timeout=30)
+
+To share the connection pool between clients pass the ``session``
+of an existing client:
+
+    >>> other = Client('http://localhost:8001', session=client.session)
+
+    >>> client.close()  # close the connections in the pool
+
+Many branches
+~~~~~~~~~~~~~
+
+Any branch can serve the API, so the client can be given a list
+of branches.  Every request is sent to the branch with the lowest
+recent latency, and is retried using another branch if the connection
+fails (``POST``, ``PUT`` and ``DELETE`` requests are only retried if the
+connection could not be established, as the request may have been
+received).  A branch failing 3 requests in a row is not used for
+30 seconds.
+
+    >>> client = Client(['http://cyme1:8000', 'http://cyme2:8000'])
+
+    >>> client.discover()   # add the other branches in the cluster
+    ['http://cyme3:8000']
+
+    >>> client.endpoints.as_list()
+    [{'url': 'http://cyme1:8000', 'latency': 0.0042,
+      'failures': 0, 'open': False}, ...]
+
+Note that branches report the address their HTTP server is bound to,
+so branches must be started with a public address to be discovered
+(branches bound to all interfaces report a loopback address, which is
+only used by clients already using a loopback address).
+
 Applications
 ~~~~~~~~~~~~
 
@@ -74,6 +115,26 @@ Instances
              'put-guarded-by-semaphore': True},
     'autoscaler': {'current': 1, 'max': 1, 'min': 1, 'qty': 0}}
 
+Many instances at once
+~~~~~~~~~~~~~~~~~~~~~~
+
+The ``*_many`` methods send their requests concurrently
+(at most ``concurrency`` requests at a time, default is 10), and return
+a mapping of every item to its result, or to the exception raised:
+
+    >>> r = app.instances.stats_many(['i1', 'i2', 'i3'])
+    >>> r.errors
+    {'i3': HTTPError('404 Client Error: NOT FOUND',)}
+    >>> r.ok
+    {'i1': {...}, 'i2': {...}}
+
+    >>> app.instances.autoscale_many({'i1': {'max': 10, 'min': 2},
+    ...                               'i2': {'max': 4}}, concurrency=50)
+    {'i1': {'max': 10, 'min': 2}, 'i2': {'max': 4, 'min': 1}}
+
+    >>> app.instances.add_many([{'broker': 'amqp://'}, {'name': 'i4'}])
+    {0: <Instance: u'4a3a5f8e-...'>, 1: <Instance: u'i4'>}
+
 Consumers
 ~~~~~~~~~
 
@@ -214,10 +275,24 @@ class Client(base.Client):
         def stats(self, name):
             return self.GET(self.path / name / 'stats')
 
+        def stats_many(self, names, concurrency=None):
+            return self.client.fan_out(self.stats,
+                                       ((name, name) for name in names),
+                                       concurrency)
+
         def autoscale(self, name, max=None, min=None):
             return self.POST(self.path / name / 'autoscale',
                              params={'max': max, 'min': min})
 
+        def autoscale_many(self, settings, concurrency=None):
+            # settings is a mapping of instance names to max/min.
+
+            def autoscale(name):
+                return self.autoscale(name, **settings[name])
+            return self.client.fan_out(autoscale,
+                                       ((name, name) for name in settings),
+                                       concurrency)
+
         def create_model(self, data, *args, **kwargs):
             data['queue_names'] = data.pop('queues', None)
             return base.Section.create_model(self, data, *args, **kwargs)
@@ -236,8 +311,14 @@ class Client(base.Client):
                                     routing_key=routing_key,
                                     options=options)
 
-    def __init__(self, url=None, app=None, info=None):
-        super(Client, self).__init__(url)
+        def depth(self, name):
+            return self.GET(self.path / name / 'depth')
+
+        def depths(self):
+            return self.GET(self.path, params={'depth': 1})
+
+    def __init__(self, url=None, app=None, info=None, **kwargs):
+        super(Client, self).__init__(url, **kwargs)
         self.app = app
         self.instances = self.Instances(self)
         self.queues = self.Queues(self)
@@ -267,17 +348,26 @@ class Client(base.Client):
     def all(self):
         return self.root('GET')
 
-    def build_url(self, path):
-        url = self.url
+    def build_path(self, path):
         if self.app:
-            url += '/' + self.app
-        return url + str(path)
+            return '/' + self.app + str(path)
+        return str(path)
+
+    def build_url(self, path):
+        return self.url + self.build_path(path)
 
     def create_model(self, name, info):
         return self.clone(app=name, info=base.AttributeDict(info))
 
     def clone(self, app=None, info=None):
-        return self.__class__(url=self.url, app=app, info=info)
+        # the clone shares the session, and so the connection pool,
+        # and the branches.
+        return self.__class__(app=app, info=info,
+                              endpoints=self.endpoints,
+                              session=self.session,
+                              pool_size=self.pool_size,
+                              timeout=self.timeout,
+                              retries=self.retries)
 
     def __repr__(self):
         url = self.build_url('')
@@ -3,9 +3,16 @@
 from __future__ import absolute_import
 
 import anyjson
+import errno
 import requests
+import socket
 
+from requests.adapters import HTTPAdapter
+
+from multiprocessing.pool import ThreadPool
+from time import time
 from urllib import quote
+from urlparse import urlparse
 
 from celery.datastructures import AttributeDict
 from dictshield.document import Document
@@ -13,6 +20,40 @@ from dictshield.document import Document
 from cyme import __version__, DEBUG
 from cyme.utils import cached_property
 
+from .endpoints import Endpoints
+
+try:
+    from requests.packages.urllib3.exceptions import ConnectTimeoutError
+except ImportError:  # pragma: no cover
+    ConnectTimeoutError = None  # noqa
+
+#: Methods without side effects, which can be sent to another branch
+#: even if the connection failed after the request was sent.
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+#: Socket errors raised when the connection could not be established.
+CONNECT_ERRNOS = frozenset([errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                            errno.ENETUNREACH, errno.EADDRNOTAVAIL])
+
+
+def is_connect_error(exc):
+    """Returns true if the :exc:`requests.ConnectionError` ``exc``
+    was raised before the connection was established, which means
+    that the request was never sent."""
+    reason = exc.args[0] if exc.args else None
+    reason = getattr(reason, 'reason', reason)  # urllib3's MaxRetryError
+    if ConnectTimeoutError is not None and \
+            isinstance(reason, ConnectTimeoutError):
+        return True
+    return (isinstance(reason, socket.gaierror) or
+            getattr(reason, 'errno', None) in CONNECT_ERRNOS)
+
+
+def is_loopback(url):
+    """Returns true if ``url`` refers to the local host."""
+    host = urlparse(url).hostname or ''
+    return host == 'localhost' or host == '::1' or host.startswith('127.')
+
 
 class Path(object):
 
@@ -52,6 +93,23 @@ class Base(object):
         return name
 
 
+class Results(dict):
+    """Results of a fan-out operation, mapping every item to the
+    value returned for it, or to the exception raised."""
+
+    @property
+    def ok(self):
+        """Items that succeeded, and their values."""
+        return dict((key, value) for key, value in self.iteritems()
+                        if not isinstance(value, Exception))
+
+    @property
+    def errors(self):
+        """Items that failed, and their exceptions."""
+        return dict((key, value) for key, value in self.iteritems()
+                        if isinstance(value, Exception))
+
+
 class Model(Document):
 
     def __init__(self, parent, *args, **kwargs):
@@ -101,6 +159,17 @@ class Section(Base):
             name = name.name
         return self.DELETE(self.maybe_async(name, nowait))
 
+    def add_many(self, specs, concurrency=None):
+        """Add many objects concurrently, where ``specs`` is a list
+        of keyword arguments to :meth:`add`.
+
+        Returns :class:`Results` mapping the index of every spec
+        to the object added.
+
+        """
+        return self.client.fan_out(lambda spec: self.add(**spec),
+                                   enumerate(specs), concurrency)
+
     def create_model(self, *args, **kwargs):
         model = self.Model(self,
                             **self.Model(self, *args, **kwargs).to_python())
@@ -117,10 +186,56 @@ class Section(Base):
 
 
 class Client(Base):
+    """Base HTTP client.
+
+    Connections are kept alive and reused between requests, using a
+    :class:`requests.Session` that can be shared between clients.
+
+    Every request is sent to the branch with the lowest recent latency
+    (see :class:`~cyme.client.endpoints.Endpoints`), and is retried
+    using another branch if the connection fails.
+
+    :keyword url: URL of the branch, or a list of branch URLs.
+    :keyword session: Session to use (default is to create a new session
+        the first time it is needed).
+    :keyword pool_size: Max number of connections kept alive per host,
+        used when creating a new session.
+    :keyword timeout: Timeout in seconds for every request
+        (default is no timeout).
+    :keyword endpoints: :class:`~cyme.client.endpoints.Endpoints` instance
+        to use instead of ``url``, used to share the branches and their
+        health between clients.
+    :keyword retries: Max number of other branches to try
+        if the connection fails.
+
+    """
     default_url = 'http://127.0.0.1:8000'
 
-    def __init__(self, url=None):
-        self.url = url.rstrip('/') if url else self.default_url
+    #: Default max number of connections kept alive per host.
+    pool_size = 10
+
+    #: Default request timeout.
+    timeout = None
+
+    #: Default max number of requests in flight for fan-out operations.
+    concurrency = 10
+
+    #: Default max number of other branches to try if the connection fails.
+    retries = 2
+
+    def __init__(self, url=None, session=None, pool_size=None, timeout=None,
+            endpoints=None, retries=None):
+        if endpoints is None:
+            urls = [url] if isinstance(url, basestring) else url
+            endpoints = Endpoints(urls or [self.default_url])
+        self.endpoints = endpoints
+        # the first branch is used when the client is represented as a URL.
+        self.url = self.endpoints.urls[0]
+        self.retries = retries if retries is not None else self.retries
+        self.pool_size = pool_size or self.pool_size
+        self.timeout = timeout if timeout is not None else self.timeout
+        if session is not None:
+            self.session = session
 
     def GET(self, path, params=None, type=None):
         return self.request('GET', path, params, None, type)
@@ -135,23 +250,25 @@ class Client(Base):
         return self.request('DELETE', path, params, data, type)
 
     def request(self, method, path, params=None, data=None, type=None):
-        return self._request(method, self.build_url(path), params, data, type)
+        return self._request(method, self.build_path(path),
+                             params, data, type)
+
+    def build_path(self, path):
+        return str(path)
 
     def _prepare(self, d):
         if d:
             return dict((key, value if value is not None else '')
                             for key, value in d.iteritems())
 
-    def _request(self, method, url, params=None, data=None, type=None):
+    def _request(self, method, path, params=None, data=None, type=None):
         data = self._prepare(data)
         params = self._prepare(params)
         if DEBUG:
-            print('<REQ> %s %r data=%r params=%r' % (method, url,  # noqa+
+            print('<REQ> %s %r data=%r params=%r' % (method, path,  # noqa+
                                                      data, params))
         type = type or AttributeDict
-        r = requests.request(method, str(url),
-                             headers=self.headers,
-                             params=params, data=data)
+        r = self._send(method, path, params=params, data=data)
         data = None
         if DEBUG:
             print('<RES> %r' % (r.text, ))  # noqa+
@@ -162,14 +279,103 @@ class Client(Base):
             return ret
         r.raise_for_status()
 
+    def _send(self, method, path, **kwargs):
+        # send request to the best endpoint, and try the next best
+        # endpoint if the connection fails.  Requests with side effects
+        # are only retried if the request was never sent.
+        tried, exc = [], None
+        for _ in xrange(self.retries + 1):
+            endpoint = self.endpoints.select(exclude=tried)
+            if endpoint is None:
+                break
+            tried.append(endpoint)
+            start = time()
+            try:
+                r = self.session.request(method, str(endpoint.url + path),
+                                         headers=self.headers,
+                                         timeout=self.timeout, **kwargs)
+            except requests.ConnectionError, exc:
+                self.endpoints.failed(endpoint)
+                if method in SAFE_METHODS or is_connect_error(exc):
+                    continue
+                raise
+            except requests.Timeout:
+                # the request may have been received, so not retried.
+                self.endpoints.failed(endpoint)
+                raise
+            self.endpoints.succeeded(endpoint, time() - start)
+            return r
+        raise exc or requests.ConnectionError('No branches available')
+
     def root(self, method, path=None, params=None, data=None):
-        return self._request(method,
-                             self.url + str(Path(path) if path else ''),
+        return self._request(method, str(Path(path)) if path else '',
                              params, data)
 
+    def discover(self):
+        """Add the URLs of all the branches in the cluster,
+        returns the list of URLs not already known.
+
+        Branches listening on all interfaces report a loopback URL,
+        which is only added if the client already uses a loopback URL
+        (i.e. the client is on the same host as the cluster).
+
+        """
+        added = []
+        local = any(is_loopback(url) for url in self.endpoints.urls)
+        for url in self.root('GET', 'branches', params={'url': 1}):
+            if not url.startswith(('http://', 'https://')):
+                # branch id returned by branches not supporting ?url.
+                url = self.root('GET', Path('branches') / url)['url']
+            if not url or (is_loopback(url) and not local):
+                continue
+            if self.endpoints.add(url):
+                added.append(url)
+        return added
+
+    def fan_out(self, fun, items, concurrency=None):
+        """Call ``fun(value)`` for every ``(key, value)`` pair in
+        ``items`` using a pool of threads, with at most ``concurrency``
+        requests in flight.
+
+        Returns :class:`Results` mapping every key to the return value
+        of ``fun``, or to the exception raised.
+
+        """
+        items = list(items)
+        if not items:
+            return Results()
+
+        def call(item):
+            key, value = item
+            try:
+                return key, fun(value)
+            except Exception, exc:
+                return key, exc
+
+        pool = ThreadPool(min(concurrency or self.concurrency, len(items)))
+        try:
+            return Results(pool.map(call, items))
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        """Close the connections kept alive by the session
+        (note that the session may be shared with other clients)."""
+        self.session.close()
+
     def __repr__(self):
         return '<Client: %r>' % (self.url, )
 
+    @cached_property
+    def session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
     @cached_property
     def headers(self):
         return {'Accept': 'application/json',
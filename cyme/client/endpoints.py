@@ -0,0 +1,144 @@
+"""cyme.client.endpoints
+
+- Keeps track of the branches a client can send requests to.
+
+- Any branch can serve the API, so every request is sent to the
+  available branch with the lowest recent latency.
+
+- A branch failing several requests in a row is not used
+  until a timeout has passed (the circuit is open), after which a single
+  request is let through to probe it (the circuit is half-open).
+
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+from threading import Lock
+from time import time
+
+
+class Endpoint(object):
+    """A branch URL and its health."""
+
+    #: Moving average of the latency of successful requests,
+    #: in seconds (:const:`None` if no requests have succeeded).
+    latency = None
+
+    #: Number of requests in a row that failed.
+    failures = 0
+
+    #: Time the circuit was opened, or :const:`None` if closed.
+    opened = None
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def as_dict(self):
+        return {'url': self.url, 'latency': self.latency,
+                'failures': self.failures, 'open': self.opened is not None}
+
+    def __repr__(self):
+        return '<Endpoint: %r latency=%r failures=%r>' % (
+                    self.url, self.latency, self.failures)
+
+
+class Endpoints(object):
+    """Selects the endpoint to send requests to.
+
+    :param urls: List of branch URLs.
+    :keyword failure_threshold: Number of failures in a row
+        before the circuit of an endpoint is opened.
+    :keyword reset_timeout: Time in seconds before a request
+        is let through to an endpoint with an open circuit.
+
+    """
+    Endpoint = Endpoint
+
+    #: Default number of failures before the circuit is opened.
+    failure_threshold = 3
+
+    #: Default time before probing an endpoint with an open circuit.
+    reset_timeout = 30.0
+
+    #: Weight of the last latency in the moving average.
+    decay = 0.3
+
+    def __init__(self, urls, failure_threshold=None, reset_timeout=None):
+        self.failure_threshold = (failure_threshold or
+                                  self.failure_threshold)
+        self.reset_timeout = reset_timeout or self.reset_timeout
+        self.endpoints = []
+        self.mutex = Lock()
+        for url in urls:
+            self.add(url)
+
+    def add(self, url):
+        """Add endpoint by URL, returns :const:`True` if it
+        was not already known."""
+        url = url.rstrip('/')
+        with self.mutex:
+            if url in self.urls:
+                return False
+            self.endpoints.append(self.Endpoint(url))
+            return True
+
+    def select(self, exclude=()):
+        """Returns the available endpoint with the fewest recent failures
+        and the lowest latency, or :const:`None` if all endpoints
+        have been tried.
+
+        Endpoints without a known latency, and endpoints where the
+        circuit has been open for ``reset_timeout`` seconds, are preferred
+        so that they are probed.  If the circuits of all endpoints are
+        open the endpoint that failed first is returned.
+
+        """
+        now = time()
+        with self.mutex:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            available = [e for e in candidates
+                            if e.opened is None
+                                or now - e.opened > self.reset_timeout]
+            if not available:
+                return min(candidates, key=lambda e: e.opened)
+            endpoint = min(available, key=self._rank)
+            if endpoint.opened is not None:
+                # half-open: let one request through, and wait
+                # another timeout before letting the next.
+                endpoint.opened = now
+            return endpoint
+
+    def _rank(self, endpoint):
+        # endpoints with an expired open circuit are probed first.
+        failures = endpoint.failures if endpoint.opened is None else 0
+        return failures, endpoint.latency or 0
+
+    def succeeded(self, endpoint, latency):
+        with self.mutex:
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency = (self.decay * latency +
+                                    (1 - self.decay) * endpoint.latency)
+            endpoint.failures = 0
+            endpoint.opened = None
+
+    def failed(self, endpoint):
+        with self.mutex:
+            endpoint.failures += 1
+            if endpoint.opened is not None or \
+                    endpoint.failures >= self.failure_threshold:
+                endpoint.opened = time()
+
+    def as_list(self):
+        return [endpoint.as_dict() for endpoint in self.endpoints]
+
+    @property
+    def urls(self):
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def __len__(self):
+        return len(self.endpoints)
@@ -9,3 +9,25 @@ from .utils import Path
 CYME_INSTANCE_DIR = Path(getattr(settings,
                         'CYME_INSTANCE_DIR', 'instances')).absolute()
 CYME_DEFAULT_POOL = getattr(settings, 'CYME_DEFAULT_POOL', 'processes')
+CYME_SUP_CONCURRENCY = int(getattr(settings, 'CYME_SUP_CONCURRENCY', 1))
+CYME_HEARTBEAT_EXPIRES = float(getattr(settings,
+                                 'CYME_HEARTBEAT_EXPIRES', 30.0))
+CYME_MAX_SPAWNS = getattr(settings, 'CYME_MAX_SPAWNS', None)
+CYME_LAUNCHER = getattr(settings, 'CYME_LAUNCHER', 'multi')
+CYME_SUP_MAX_RESTARTS = getattr(settings, 'CYME_SUP_MAX_RESTARTS', None)
+CYME_PRESENCE_SNAPSHOT_INTERVAL = float(getattr(settings,
+                        'CYME_PRESENCE_SNAPSHOT_INTERVAL', 120.0))
+CYME_APP_CACHE_LIMIT = int(getattr(settings, 'CYME_APP_CACHE_LIMIT', 1000))
+CYME_APP_CACHE_TTL = float(getattr(settings, 'CYME_APP_CACHE_TTL', 300.0))
+CYME_PLACEMENT_POLICY = getattr(settings, 'CYME_PLACEMENT_POLICY',
+                                'least-loaded')
+CYME_AUTOSCALE_INTERVAL = float(getattr(settings,
+                                'CYME_AUTOSCALE_INTERVAL', 10.0))
+CYME_AUTOSCALE_TASKS_PER_PROCESS = int(getattr(settings,
+                                'CYME_AUTOSCALE_TASKS_PER_PROCESS', 10))
+CYME_PUBLISH_CONFIRMS = getattr(settings, 'CYME_PUBLISH_CONFIRMS', False)
+CYME_PUBLISH_CONFIRM_WINDOW = float(getattr(settings,
+                                'CYME_PUBLISH_CONFIRM_WINDOW', 0.005))
+CYME_PUBLISH_CONFIRM_TIMEOUT = float(getattr(settings,
+                                'CYME_PUBLISH_CONFIRM_TIMEOUT', 10.0))
+CYME_QUEUE_DEPTH_TTL = float(getattr(settings, 'CYME_QUEUE_DEPTH_TTL', 2.0))
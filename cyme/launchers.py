@@ -0,0 +1,178 @@
+"""cyme.launchers
+
+- Launchers are used by :class:`~cyme.models.Instance` to start, stop
+  and restart the worker processes.
+
+- The default launcher executes :program:`celeryd-multi` commands,
+  while the ``native`` launcher spawns the workers directly and keeps
+  track of them as child processes of the branch.
+
+- The launcher used is selected by the ``CYME_LAUNCHER`` setting.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import errno
+import os
+import shlex
+import sys
+
+from signal import SIGKILL, SIGTERM
+from subprocess import Popen
+from time import sleep, time
+
+from celery.platforms import signals
+from celery.utils import get_cls_by_name
+from celery.utils.encoding import safe_str
+from cell.g import spawn
+from kombu.log import get_logger
+
+from cyme.utils import find_symbol
+
+logger = get_logger('Launcher')
+
+#: Launcher aliases that can be used with the ``CYME_LAUNCHER`` setting.
+LAUNCHERS = {'multi': 'cyme.launchers.MultiLauncher',
+             'native': 'cyme.launchers.ProcessLauncher'}
+
+_launchers = {}
+
+
+class MultiLauncher(object):
+    """Executes :program:`celeryd-multi` commands."""
+
+    def execute(self, instance, action, multi='celeryd-multi'):
+        argv = instance.get_multi_argv(action, multi)
+        logger.info(' '.join(argv))
+        return instance.multi.execute_from_commandline(argv)
+
+
+class ProcessLauncher(object):
+    """Spawns worker processes directly, without going through
+    :program:`celeryd-multi`.
+
+    The processes are kept in memory as children of the branch, and
+    are reaped when the branch receives :sig:`SIGCHLD`, at which point the
+    supervisor is asked to verify the instance (which will restart
+    the instance if it is still enabled).
+
+    """
+
+    #: Seconds to wait for a worker to exit after :sig:`SIGTERM`,
+    #: before it is killed by :sig:`SIGKILL`.
+    stop_timeout = 60.0
+
+    def __init__(self):
+        self.children = {}
+        self._sigchld_installed = False
+
+    def execute(self, instance, action, **kwargs):
+        return getattr(self, action)(instance)
+
+    def start(self, instance):
+        if instance.responds_to_signal():
+            return
+        self.install_sigchld_handler()
+        argv = self.get_argv(instance)
+        logger.info(' '.join(argv))
+        with open(os.devnull, 'w') as devnull:
+            self.children[instance.name] = Popen(argv, env=self.env,
+                                                 cwd=instance.instance_dir,
+                                                 stdout=devnull,
+                                                 stderr=devnull,
+                                                 close_fds=True)
+
+    def stop(self, instance):
+        pid = self.getpid(instance)
+        if pid:
+            self.kill(pid, SIGTERM)
+        return pid
+
+    def stop_verify(self, instance):
+        pid = self.stop(instance)
+        if pid:
+            time_start = time()
+            while self.kill(pid, 0):
+                if time() - time_start > self.stop_timeout:
+                    logger.warning('%s: not stopped after %ss, killing',
+                                   instance.name, self.stop_timeout)
+                    self.kill(pid, SIGKILL)
+                    break
+                sleep(0.5)
+
+    def restart(self, instance):
+        self.stop_verify(instance)
+        self.start(instance)
+
+    def getpid(self, instance):
+        try:
+            return self.children[instance.name].pid
+        except KeyError:
+            return instance.getpid()
+
+    def kill(self, pid, signum):
+        """Send signal to process, returns :const:`False` if
+        the process does not exist."""
+        try:
+            os.kill(pid, signum)
+        except OSError, exc:
+            if exc.errno == errno.ESRCH:
+                return False
+            raise
+        return True
+
+    def get_argv(self, instance):
+        return ([sys.executable, '-m', 'celery.bin.celeryd',
+                 '-n', instance.name]
+              + shlex.split(safe_str(' '.join(instance.get_arguments())))
+              + ['--']
+              + instance.get_extra_config())
+
+    def install_sigchld_handler(self):
+        if not self._sigchld_installed:
+            signals['CHLD'] = self._on_sigchld
+            self._sigchld_installed = True
+
+    def _on_sigchld(self, signum, frame):
+        for name, process in self.children.items():
+            if process.poll() is not None:
+                self.children.pop(name, None)
+                self.on_child_exit(name, process.returncode)
+
+    def on_child_exit(self, name, exitcode):
+        logger.info('%s: worker exited with exitcode %r', name, exitcode)
+        spawn(self._verify_after_exit, name)
+
+    def _verify_after_exit(self, name):
+        instances = find_symbol(self, 'cyme.models.Instance')._default_manager
+        supervisor = find_symbol(self, 'cyme.branch.supervisor.supervisor')
+        try:
+            instance = instances.get(name=name)
+        except instances.model.DoesNotExist:
+            return
+        supervisor.verify([instance], ratelimit=True)
+
+    @property
+    def env(self):
+        env = os.environ.copy()
+        env.pop('CELERY_LOADER', None)
+        return env
+
+
+def get_launcher(name=None):
+    """Returns the launcher by alias or class name, the default
+    is the launcher selected by the ``CYME_LAUNCHER`` setting.
+
+    Launchers are shared by all instances.
+
+    """
+    if name is None:
+        from cyme.conf import CYME_LAUNCHER as name
+    try:
+        return _launchers[name]
+    except KeyError:
+        launcher = _launchers[name] = get_cls_by_name(
+                                        LAUNCHERS.get(name, name))()
+        return launcher
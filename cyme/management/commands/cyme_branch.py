@@ -42,6 +42,11 @@ Options
 
     Supervisor schedule Interval in seconds.  Default is 5.
 
+.. cmdoption:: --sup-concurrency
+
+    Max number of instances the supervisor will verify/restart
+    concurrently.  Default is the ``CYME_SUP_CONCURRENCY`` setting (1).
+
 """
 
 from __future__ import absolute_import
@@ -68,7 +73,8 @@ BANNER = """
 -- * - **** ---   . url:         http://%(addr)s:%(port)s
 - ** ----------   . broker:      %(broker)s
 - ** ----------   . logfile:     %(logfile)s@%(loglevel)s
-- ** ----------   . sup:         interval=%(sup.interval)s
+- ** ----------   . sup:         interval=%(sup.interval)s \
+concurrency=%(sup.concurrency)s
 - ** ----------   . presence:    interval=%(presence.interval)s
 - *** --- * ---   . controllers: #%(controllers)s
 -- ******* ----   . instancedir: %(instance_dir)s
@@ -113,6 +119,11 @@ class Command(CymeCommand):
        Option('--sup-interval',
               default=60, action='store', type='int', dest='sup_interval',
               help='Supervisor schedule interval.  Default is every minute.'),
+       Option('--sup-concurrency',
+              default=None, action='store', type='int',
+              dest='sup_concurrency',
+              help='Max number of instances the supervisor operates on '
+                   'concurrently.  Default is CYME_SUP_CONCURRENCY (1).'),
     ) + daemon_options(default_detach_pidfile)
 
     _startup_pbar = None
@@ -124,6 +135,7 @@ class Command(CymeCommand):
         self.logfile = kwargs.get('logfile')
         self.enter_instance_dir()
         self.env.syncdb(interactive=False)
+        self.upgrade_db()
         self.install_cry_handler()
         self.install_rdb_handler()
         self.colored = celery.log.colored(kwargs.get('logfile'))
@@ -135,6 +147,15 @@ class Command(CymeCommand):
         self.detached = kwargs.get('detach', False)
         return (self._detach if self.detached else self._start)(**kwargs)
 
+    def upgrade_db(self):
+        # syncdb does not alter existing tables, so columns added
+        # since the table was created must be added here, and
+        # instances saved before the queue index was introduced
+        # must be indexed, which is only done once.
+        from cyme.models import Instance
+        Instance.objects.maybe_add_version_column()
+        Instance.objects.maybe_build_queue_index()
+
     def setup_default_env(self, env):
         env.setup_eventlet()
         env.setup_pool_limit()
@@ -193,6 +214,7 @@ class Command(CymeCommand):
                          'addr': addr or 'localhost',
                          'port': port or 8000,
                          'sup.interval': sup.interval,
+                         'sup.concurrency': sup.concurrency,
                          'presence.interval': pres_interval,
                          'controllers': len(con),
                          'instance_dir': self.instance_dir}
@@ -248,6 +270,10 @@ class Command(CymeCommand):
                  self.signals.thread_post_start)
         osigs = (self.signals.httpd_ready,
                  self.signals.supervisor_ready,
+                 self.signals.heartbeats_ready,
+                 self.signals.replies_ready,
+                 self.signals.autoscaler_ready,
+                 self.signals.confirms_ready,
                  self.signals.controller_ready,
                  self.signals.branch_ready)
 
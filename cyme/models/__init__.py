@@ -8,7 +8,7 @@ import os
 import shlex
 import warnings
 
-from threading import Lock
+from threading import BoundedSemaphore
 
 from anyjson import deserialize
 from celery import current_app as celery
@@ -23,7 +23,7 @@ from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
 from . import managers
-from cyme.utils import cached_property, find_symbol
+from cyme.utils import DummyLock, LockMap, cached_property, find_symbol
 
 logger = get_logger('Instance')
 
@@ -64,6 +64,40 @@ class Broker(models.Model):
         """Producer pool for this connection."""
         return producers[self.connection]
 
+    def queue_depths(self, names):
+        """Returns the number of messages and consumers of queues,
+        as a ``{name: {'messages': int, 'consumers': int}}`` mapping.
+
+        The queues are declared passively, using a single channel
+        from the connection pool, and queues that does
+        not exist are not included.
+
+        """
+        depths = {}
+        with self.pool.acquire(block=True) as conn:
+            channel = conn.channel()
+            try:
+                for name in names:
+                    try:
+                        _, messages, consumers = channel.queue_declare(
+                                                    queue=name, passive=True)
+                    except conn.channel_errors:
+                        # the queue does not exist, which closes the channel.
+                        self._close_channel(conn, channel)
+                        channel = conn.channel()
+                        continue
+                    depths[name] = {'messages': messages,
+                                    'consumers': consumers}
+            finally:
+                self._close_channel(conn, channel)
+        return depths
+
+    def _close_channel(self, conn, channel):
+        try:
+            channel.close()
+        except conn.connection_errors + conn.channel_errors:
+            pass
+
     @cached_property
     def connection(self):
         return celery.broker_connection(self.url)
@@ -130,6 +164,45 @@ class Queue(models.Model):
                 'options': self.options}
 
 
+def queue_name(queue):
+    """Returns the name of a :class:`Queue`, or ``queue`` if it
+    is already a name."""
+    return queue.name if isinstance(queue, Queue) else queue
+
+
+class Queues(list):
+    """The names of the queues an instance consumes from.
+
+    Changes made using :meth:`add` and :meth:`remove` are written back
+    to the instance, but the instance must be saved for the change
+    to take effect.
+
+    """
+
+    def __init__(self, instance, queues=()):
+        self.instance = instance
+        list.__init__(self, queues)
+
+    def add(self, queue):
+        queue = queue_name(queue)
+        if queue not in self:
+            self.append(queue)
+            self._update_obj()
+
+    def remove(self, queue):
+        try:
+            list.remove(self, queue_name(queue))
+        except ValueError:
+            pass
+        self._update_obj()
+
+    def as_str(self):
+        return ','.join(map(queue_name, self))
+
+    def _update_obj(self):
+        self.instance.queues = self.as_str()
+
+
 class Instance(models.Model):
     """A celeryd instance."""
     App = App
@@ -138,7 +211,16 @@ class Instance(models.Model):
     MultiTool = MultiTool
 
     objects = managers.InstanceManager()
-    mutex = Lock()
+
+    #: Locks held while executing commands for an instance (by name),
+    #: so that commands for different instances can run concurrently.
+    locks = LockMap()
+
+    #: Limits the number of commands executing at the same time
+    #: (see :meth:`spawn_limit`).
+    _spawn_limit = None
+
+    _queues_cache = None
 
     app = models.ForeignKey(App)
     name = models.CharField(_(u'name'), max_length=128, unique=True)
@@ -151,6 +233,8 @@ class Instance(models.Model):
     _broker = models.ForeignKey(Broker, null=True, blank=True)
     arguments = models.TextField(_(u'arguments'), null=True, blank=True)
     extra_config = models.TextField(_(u'extra config'), null=True, blank=True)
+    version = models.PositiveIntegerField(_(u'version'), default=0,
+                                          editable=False)
 
     class Meta:
         verbose_name = _(u'instance')
@@ -166,6 +250,27 @@ class Instance(models.Model):
         if not isinstance(app, self.App):
             kwargs['app'] = self.App._default_manager.get(name=app)
         super(Instance, self).__init__(*args, **kwargs)
+        # used to find out if the queue index must be updated on save.
+        self._queues_saved = self._queues if self.pk else None
+
+    def save(self, *args, **kwargs):
+        # the version is bumped for every change, so that the supervisor
+        # can find the instances changed since they were last verified.
+        self.version += 1
+        super(Instance, self).save(*args, **kwargs)
+        if (self._queues or '') != (self._queues_saved or ''):
+            self.update_queue_index()
+
+    def update_queue_index(self):
+        """Update the :class:`InstanceQueue` rows for this instance
+        to match the queues listed in :attr:`queues`."""
+        current = set(self.consumers.values_list('queue', flat=True))
+        wanted = set(self.queues)
+        if current - wanted:
+            self.consumers.filter(queue__in=current - wanted).delete()
+        for queue in wanted - current:
+            self.consumers.create(queue=queue)
+        self._queues_saved = self._queues
 
     def as_dict(self):
         """Returns dictionary representation of this instance that
@@ -223,9 +328,15 @@ class Instance(models.Model):
         self.save()
         return [self.max_concurrency, self.min_concurrency]
 
-    def autoscale(self, max=None, min=None, **kwargs):
-        """Set max/min autoscale settings."""
-        self._update_autoscale(max, min)
+    def autoscale(self, max=None, min=None, save=True, **kwargs):
+        """Set max/min autoscale settings.
+
+        If ``save`` is false the settings are only sent to the worker,
+        and not stored in the model.
+
+        """
+        if save:
+            self._update_autoscale(max, min)
         return self._query('autoscale', dict(max=max, min=min), **kwargs)
 
     def responds_to_ping(self, **kwargs):
@@ -249,7 +360,13 @@ class Instance(models.Model):
 
     def consuming_from(self, **kwargs):
         """Returns the queues the instance is currently consuming from."""
-        queues = self._query('active_queues', **kwargs)
+        return self.parse_active_queues(self._query('active_queues',
+                                                    **kwargs))
+
+    @staticmethod
+    def parse_active_queues(queues):
+        """Convert ``active_queues`` reply to a ``{name: queue}``
+        mapping."""
         return dict((q['name'], q) for q in queues) if queues else {}
 
     def add_queue_eventually(self, q):
@@ -313,16 +430,30 @@ class Instance(models.Model):
               + shsplit(self.app.extra_config)
               + shsplit(self.extra_config))
 
-    def _action(self, action, multi='celeryd-multi'):
-        """Execute :program:`celeryd-multi` command."""
-        with self.mutex:
-            argv = ([multi, action, '--nosplash', '--suffix=''', '--no-color']
-                  + [self.name]
-                  + self.get_arguments()
-                  + ['--']
-                  + self.get_extra_config())
-            logger.info(' '.join(argv))
-            return self.multi.execute_from_commandline(argv)
+    def get_multi_argv(self, action, multi='celeryd-multi'):
+        return ([multi, action, '--nosplash', '--suffix=''', '--no-color']
+              + [self.name]
+              + self.get_arguments()
+              + ['--']
+              + self.get_extra_config())
+
+    def _action(self, action, **kwargs):
+        """Execute action using the launcher (by default this executes
+        a :program:`celeryd-multi` command)."""
+        with self.locks[self.name]:
+            with self.spawn_limit():
+                return self.launcher.execute(self, action, **kwargs)
+
+    @classmethod
+    def spawn_limit(cls):
+        """Returns the semaphore limiting the number of
+        :program:`celeryd-multi` commands executing at the same time
+        on this branch, as set by the ``CYME_MAX_SPAWNS`` setting."""
+        if cls._spawn_limit is None:
+            limit = find_symbol(cls, 'cyme.conf.CYME_MAX_SPAWNS')
+            cls._spawn_limit = (BoundedSemaphore(int(limit)) if limit
+                                    else DummyLock())
+        return cls._spawn_limit
 
     def _query(self, cmd, args={}, **kwargs):
         """Send remote control command and wait for this instances reply."""
@@ -336,9 +467,8 @@ class Instance(models.Model):
         try:
             try:
                 with Timeout(timeout):
-                    r = celery.control.broadcast(cmd,
-                                                 arguments=args, reply=True,
-                                                 destination=[name], **kwargs)
+                    r = self.broadcast(self.broker, cmd, args, [name],
+                                       **kwargs)
             except Timeout:
                 return None
             return self.my_reply(r)
@@ -346,12 +476,76 @@ class Instance(models.Model):
             if producer is not None:
                 producer.release()
 
+    @classmethod
+    def broadcast(cls, broker, cmd, args, destination, **kwargs):
+        """Send remote control command to ``destination``
+        and return the replies.
+
+        When running as a branch the replies are collected using the
+        branch's shared reply consumer for this broker, instead of
+        setting up a new reply queue for every command.
+
+        """
+        replies = find_symbol(cls, 'cyme.branch.replies.replies')
+        consumer = replies.get(broker.url)
+        if consumer is not None:
+            return consumer.call(cmd, args, destination, **kwargs)
+        return celery.control.broadcast(cmd, arguments=args, reply=True,
+                                        destination=destination, **kwargs)
+
+    @classmethod
+    def query_all(cls, instances, cmd, args={}, **kwargs):
+        """Send remote control command to several instances using
+        a single broadcast, and collect replies until all of them
+        have replied or the timeout is exceeded.
+
+        The instances must all be using the same broker.
+
+        Returns a ``{name: reply}`` mapping of the instances that replied.
+
+        """
+        names = [instance.name for instance in instances]
+        if not names:
+            return {}
+        timeout = kwargs.setdefault('timeout', 3)
+        kwargs.setdefault('limit', len(names))
+        producer = None
+        if 'connection' not in kwargs:
+            producer = instances[0].broker.producers.acquire(block=True,
+                                                             timeout=3)
+            kwargs.update(connection=producer.connection,
+                          channel=producer.channel)
+        try:
+            try:
+                # the broadcast returns when the timeout is exceeded,
+                # this is only a safeguard.
+                with Timeout(timeout * 2):
+                    r = cls.broadcast(instances[0].broker, cmd, args, names,
+                                      **kwargs)
+            except Timeout:
+                return {}
+            replies = {}
+            for reply in r or []:
+                replies.update((name, value)
+                                for name, value in reply.iteritems()
+                                    if name in names)
+            return replies
+        finally:
+            if producer is not None:
+                producer.release()
+
     def my_reply(self, replies):
         name = self.name
         for reply in replies or []:
             if name in reply:
                 return reply[name]
 
+    @property
+    def launcher(self):
+        """The launcher used to start/stop the worker, as selected by
+        the ``CYME_LAUNCHER`` setting."""
+        return find_symbol(self, 'cyme.launchers.get_launcher')()
+
     @cached_property
     def multi(self):
         env = os.environ.copy()
@@ -403,39 +597,18 @@ class Instance(models.Model):
         return self._broker
 
     def _get_queues(self):
-        instance = self
-
-        class Queues(list):
-
-            def add(self, queue):
-                if queue not in self:
-                    self.append(queue)
-                    self._update_obj()
-
-            def remove(self, queue):
-                try:
-                    list.remove(self, queue)
-                except ValueError:
-                    pass
-                self._update_obj()
-
-            def as_str(self):
-
-                def mq(q):
-                    if isinstance(q, Queue):
-                        return q.name
-                    return q
-
-                return ','.join(map(mq, self))
-
-            def _update_obj(self):
-                instance.queues = self.as_str()
-
-        return Queues(q for q in (self._queues or '').split(',') if q)
+        raw = self._queues or ''
+        cached = self._queues_cache
+        if cached is None or cached[0] != raw:
+            cached = self._queues_cache = (raw,
+                                tuple(q for q in raw.split(',') if q))
+        # a new list every time, so changes made to it in place
+        # does not affect the cache.
+        return Queues(self, cached[1])
 
     def _set_queues(self, queues):
         if not isinstance(queues, basestring):
-            queues = ','.join(queues)
+            queues = ','.join(map(queue_name, queues))
         self._queues = queues
 
     queues = property(_get_queues, _set_queues)
@@ -449,3 +622,23 @@ class Instance(models.Model):
         dir = find_symbol(self, 'cyme.conf.CYME_INSTANCE_DIR') / self.name
         dir.mkdir()
         return dir
+
+
+class InstanceQueue(models.Model):
+    """Index of the queues consumed from by instances,
+    kept in sync with :attr:`Instance.queues` when an instance is saved.
+
+    Used to find the instances consuming from a queue without having
+    to scan every instance.
+
+    """
+    instance = models.ForeignKey(Instance, related_name='consumers')
+    queue = models.CharField(_(u'queue'), max_length=128, db_index=True)
+
+    class Meta:
+        verbose_name = _(u'instance queue')
+        verbose_name_plural = _(u'instance queues')
+        unique_together = ('instance', 'queue')
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.instance_id, self.queue)
@@ -12,6 +12,7 @@ from __future__ import absolute_import
 
 from anyjson import serialize
 from celery import current_app as celery
+from django.db import connection, transaction
 from djcelery.managers import ExtendedManager
 
 from cyme.utils import cached_property, uuid
@@ -66,6 +67,52 @@ class InstanceManager(ExtendedManager):
     def enabled(self):
         return self.filter(is_enabled=True)
 
+    def consuming_from(self, queue):
+        """Returns the instances consuming from ``queue``."""
+        return self.filter(consumers__queue=self._queue_name(queue))
+
+    def maybe_build_queue_index(self):
+        """Build the queue index if it is empty, but there are instances
+        consuming from queues (i.e. instances saved before the
+        queue index was introduced).
+
+        Returns :const:`True` if the index was built.
+
+        """
+        if self.filter(consumers__isnull=False).exists():
+            return False
+        instances = self.exclude(_queues__isnull=True).exclude(_queues='')
+        if not instances.exists():
+            return False
+        for instance in instances.iterator():
+            instance.update_queue_index()
+        return True
+
+    def maybe_add_version_column(self):
+        """Add the ``version`` column to the instance table if missing
+        (i.e. the table was created before the column was introduced,
+        as ``syncdb`` does not alter existing tables).
+
+        Returns :const:`True` if the column was added.
+
+        """
+        table = self.model._meta.db_table
+        field = self.model._meta.get_field('version')
+        cursor = connection.cursor()
+        description = connection.introspection.get_table_description(cursor,
+                                                                     table)
+        if field.column in [column[0] for column in description]:
+            return False
+        qn = connection.ops.quote_name
+        cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NOT NULL DEFAULT %d'
+                % (qn(table), qn(field.column),
+                   field.db_type(connection=connection), field.default))
+        transaction.commit_unless_managed()
+        return True
+
+    def _queue_name(self, queue):
+        return queue.name if isinstance(queue, self.model.Queue) else queue
+
     def _maybe_queues(self, queues):
         if isinstance(queues, basestring):
             queues = queues.split(',')
@@ -109,16 +156,17 @@ class InstanceManager(ExtendedManager):
 
     def remove_queue_from_instances(self, queue, **query):
         instances = []
-        for instance in self.filter(**query).iterator():
-            if queue in instance.queues:
-                instance.queues.remove(queue)
-                instance.save()
-                instances.append(instance)
+        for instance in list(self.consuming_from(queue).filter(**query)):
+            instance.queues.remove(queue)
+            instance.save()
+            instances.append(instance)
         return instances
 
     def add_queue_to_instances(self, queue, **query):
         instances = []
-        for instance in self.filter(**query).iterator():
+        queue = self._queue_name(queue)
+        for instance in self.filter(**query).exclude(
+                consumers__queue=queue).iterator():
             instance.queues.add(queue)
             instance.save()
             instances.append(instance)
@@ -3,6 +3,8 @@
 from __future__ import absolute_import, with_statement
 
 from collections import defaultdict
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 from celery.datastructures import TokenBucket
 from celery.utils.timeutils import rate
@@ -10,7 +12,10 @@ from kombu.common import insured as _insured
 from kombu.log import LogMixin
 from kombu.utils import fxrangemax
 
+from . import conf
 from .models import Instance
+from .branch.autoscaler import autoscaler
+from .branch.heartbeats import heartbeats
 from .branch.state import state
 
 
@@ -18,29 +23,90 @@ class Status(LogMixin):
     paused = False
     restart_max_rate = '100/s'
 
+    #: Max number of instances to operate on concurrently
+    #: (default is the ``CYME_SUP_CONCURRENCY`` setting).
+    concurrency = None
+
     def __init__(self):
         self._buckets = defaultdict(lambda: TokenBucket(
                                         rate(self.restart_max_rate)))
 
     def start_all(self):
-        for instance in self.all_instances():
-            self._do_verify_instance(instance, ratelimit=False)
+        instances = list(self.all_instances())
+        snapshot = self.snapshot(instances)
+        for instance in instances:
+            self._do_verify_instance(instance, ratelimit=False,
+                                     snapshot=snapshot)
 
     def restart_all(self):
-        for instance in self.all_instances():
-            self._do_restart_instance(instance, ratelimit=False)
+        self.map_all(partial(self._do_restart_instance, ratelimit=False),
+                     self.all_instances())
 
     def shutdown_all(self):
-        for instance in self.all_instances():
+
+        def stop(instance):
             try:
                 self._do_stop_verify_instance(instance)
             except Exception, exc:
                 self.error("Couldn't stop instance %s: %r" % (instance.name,
                                                               exc))
+        self.map_all(stop, self.all_instances())
+
+    def map_all(self, fun, instances):
+        """Apply ``fun`` to every instance, operating on up to
+        :attr:`concurrency` instances at a time."""
+        concurrency = self.concurrency or conf.CYME_SUP_CONCURRENCY
+        if concurrency > 1:
+            pool = ThreadPool(concurrency)
+            try:
+                return pool.map(fun, instances)
+            finally:
+                pool.close()
+                pool.join()
+        return map(fun, instances)
 
     def all_instances(self):
         return Instance.objects.all()
 
+    def query_all(self, instances, cmd, **kwargs):
+        """Send remote control command to several instances using one
+        broadcast per broker.
+
+        Returns a ``{name: reply}`` mapping of the instances that replied.
+
+        """
+        by_broker = defaultdict(list)
+        for instance in instances:
+            by_broker[instance.broker.url].append(instance)
+        replies = {}
+        for group in by_broker.itervalues():
+            replies.update(self.insured(group[0], Instance.query_all,
+                                        group, cmd, **kwargs))
+        return replies
+
+    def snapshot(self, instances, **kwargs):
+        """Collect the ``ping``, ``stats`` and ``active_queues`` replies
+        for several instances, using one broadcast for each command.
+
+        Instances that recently sent a heartbeat are not pinged, and
+        only the instances known to be alive are asked for
+        ``stats`` and ``active_queues``, so that the broadcasts can
+        return as soon as all of them have replied.
+
+        Returns a ``{command: {name: reply}}`` mapping.
+
+        """
+        silent = [instance for instance in instances
+                    if not heartbeats.is_alive(instance.name)]
+        ping = self.query_all(silent, 'ping', **kwargs)
+        alive = [instance for instance in instances
+                    if instance.name in ping
+                        or heartbeats.is_alive(instance.name)]
+        return {'ping': ping,
+                'stats': self.query_all(alive, 'stats', **kwargs),
+                'active_queues': self.query_all(alive, 'active_queues',
+                                                **kwargs)}
+
     def insured(self, instance, fun, *args, **kwargs):
         """Ensures any function performing a broadcast command completes
         despite intermittent connection failures."""
@@ -114,22 +180,51 @@ class Status(LogMixin):
         self.info('%s instance.shutdown' % (instance, ))
         instance.stop_verify()
 
-    def _do_verify_instance(self, instance, ratelimit=False):
+    def _do_verify_instance(self, instance, ratelimit=False, snapshot=None):
         if not self.paused:
             if instance.is_enabled and instance.pk:
-                if not self.ib(instance.alive):
+                if not self._is_alive(instance, snapshot):
                     self._do_restart_instance(instance, ratelimit=ratelimit)
-                self._verify_instance_processes(instance)
-                self._verify_instance_queues(instance)
+                    snapshot = None  # replies are stale after restart.
+                self._verify_instance_processes(instance, snapshot)
+                self._verify_instance_queues(instance, snapshot)
             else:
-                if self.ib(instance.alive):
+                if self._is_alive(instance, snapshot):
                     self._do_stop_instance(instance)
 
-    def _verify_instance_queues(self, instance):
+    def _snapshot_reply(self, snapshot, cmd, instance):
+        """Returns the reply to ``cmd`` from a :meth:`snapshot`,
+        or raises :exc:`KeyError` if the instance is not part of it."""
+        if not snapshot:
+            raise KeyError(cmd)
+        return snapshot[cmd][instance.name]
+
+    def _is_alive(self, instance, snapshot=None):
+        """Returns true if the instance is alive.
+
+        Instances that recently sent a heartbeat are considered alive
+        as long as the process exists, and instances that did not reply
+        to the ping in ``snapshot`` are pinged again individually before
+        being considered dead.
+
+        """
+        if heartbeats.is_alive(instance.name):
+            return instance.responds_to_signal()
+        try:
+            self._snapshot_reply(snapshot, 'ping', instance)
+        except KeyError:
+            return self.ib(instance.alive)
+        return instance.responds_to_signal()
+
+    def _verify_instance_queues(self, instance, snapshot=None):
         """Verify that the queues the instance is consuming from matches
         the queues listed in the model."""
         queues = set(instance.queues)
-        reply = self.ib(instance.consuming_from)
+        try:
+            reply = instance.parse_active_queues(
+                    self._snapshot_reply(snapshot, 'active_queues', instance))
+        except KeyError:
+            reply = self.ib(instance.consuming_from)
         if reply is None:
             return
         consuming_from = set(reply.keys())
@@ -145,15 +240,20 @@ class Status(LogMixin):
                     '%s: instance.cancel_consume: %s' % (instance, queue))
                 self.ib(instance.cancel_queue, queue)
 
-    def _verify_instance_processes(self, instance):
+    def _verify_instance_processes(self, instance, snapshot=None):
         """Verify that the max/min concurrency settings of the
-        instance matches that which is specified in the model."""
-        max, min = instance.max_concurrency, instance.min_concurrency
+        instance matches that which is specified in the model
+        (the min concurrency may have been raised by the autoscaler)."""
+        max, min = instance.max_concurrency, autoscaler.min_for(instance)
+        try:
+            stats = self._snapshot_reply(snapshot, 'stats', instance)
+        except KeyError:
+            stats = self.insured(instance, instance.stats)
         try:
-            current = self.insured(instance, instance.stats)['autoscaler']
+            current = stats['autoscaler']
         except (TypeError, KeyError):
             return
         if max != current['max'] or min != current['min']:
             self.info('%s: instance.set_autoscale max=%r min=%r' % (
                 instance, max, min))
-            self.ib(instance.autoscale, max, min)
+            self.ib(instance.autoscale, max, min, save=False)
@@ -0,0 +1,299 @@
+from __future__ import absolute_import
+
+from StringIO import StringIO
+
+from anyjson import deserialize
+from celery import states
+from celery.tests.utils import unittest
+from cell.exceptions import NoRouteError
+from mock import Mock, patch
+
+from cyme.api import views
+from cyme.api.fastpath import FastPath
+from cyme.api.web import ApiView, StreamingJsonResponse, iter_json_array
+from cyme.branch.events import TaskEventConsumer
+
+
+class test_StreamingJsonResponse(unittest.TestCase):
+
+    def test_iter_json_array(self):
+        self.assertEqual(''.join(iter_json_array(iter([1, 'a']))),
+                         '[1, "a"]')
+        self.assertEqual(''.join(iter_json_array(iter([]))), '[]')
+
+    def test_first_value_error_raised(self):
+
+        def values():
+            raise NoRouteError('foo')
+            yield 1
+
+        with self.assertRaises(NoRouteError):
+            StreamingJsonResponse(values())
+
+    def test_first_value_kept(self):
+        response = StreamingJsonResponse(iter([1, 2]))
+        self.assertEqual(''.join(response), '[1, 2]')
+
+
+class test_ApiView(unittest.TestCase):
+
+    def test_typemap_bool(self):
+        to_bool = ApiView.typemap[bool]
+        for value in ('1', 'true', 'True', 'yes', 'on'):
+            self.assertTrue(to_bool(value))
+        for value in ('', '0', 'false', 'False', 'no', 'off'):
+            self.assertFalse(to_bool(value))
+
+
+class test_Instance(unittest.TestCase):
+
+    def post(self, **params):
+        view = views.Instance()
+        view.request = Mock(GET={}, POST=params)
+        return view.post(view.request, 'app', 'foo')
+
+    @patch('cyme.api.views.instances')
+    def test_post_policy(self, instances):
+        instances.add.return_value = {'name': 'foo'}
+        self.post(policy='spread')
+        self.assertEqual(instances.add.call_args[1]['policy'], 'spread')
+
+    @patch('cyme.api.views.instances')
+    def test_post_unknown_policy(self, instances):
+        for policy in ('foo', 'cyme.branch.placement.LeastLoaded',
+                       'os.system'):
+            response = self.post(policy=policy)
+            self.assertEqual(response.status_code, 400)
+            self.assertTrue(deserialize(response.content)['nok'])
+        self.assertFalse(instances.add.call_count)
+
+
+class test_parse(unittest.TestCase):
+
+    def test_parse_apply_path(self):
+        self.assertEqual(views.parse_apply_path('foo/http://e.com/x?y=1'),
+                         ('foo', 'http://e.com/x?y=1'))
+        self.assertEqual(views.parse_apply_path('foo/bar/https://e.com/'),
+                         ('foo/bar', 'https://e.com/'))
+        self.assertEqual(views.parse_apply_path('foo/'), ('foo', None))
+
+    def test_parse_bulk(self):
+        tasks = [{'url': 'http://e.com/a'},
+                 {'url': 'http://e.com/b', 'method': 'POST',
+                  'data': {'x': 1}}]
+        self.assertEqual(views.parse_bulk(
+            '[{"url": "http://e.com/a"}, {"url": "http://e.com/b", '
+            '"method": "POST", "data": {"x": 1}}]'), tasks)
+        for body in ('', 'foo', '{"url": "http://e.com/"}', '[1]',
+                     '[{"method": "GET"}]'):
+            with self.assertRaises(ValueError):
+                views.parse_bulk(body)
+
+    def test_apply_bulk_bad_request(self):
+        response = views.apply_bulk().post(Mock(raw_post_data='foo'),
+                                           'app', 'queue')
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(deserialize(response.content)['nok'])
+
+
+class test_FastPath(unittest.TestCase):
+
+    def setUp(self):
+        self.fallback = Mock()
+        self.fallback.return_value = ['fallback']
+        self.app = FastPath(self.fallback)
+
+    def request(self, path, method='GET', body='', content_type='',
+            query=''):
+        status = []
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': method,
+                   'QUERY_STRING': query, 'CONTENT_TYPE': content_type,
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': StringIO(body)}
+        response = self.app(environ,
+                            lambda s, headers: status.append(s))
+        if response == ['fallback']:
+            return None, None
+        body = ''.join(response)
+        return int(status[0].split()[0]), deserialize(body) if body else None
+
+    def test_ping(self):
+        self.assertEqual(self.request('/ping/'), (200, {'ok': 'pong'}))
+
+    def test_fallback(self):
+        self.assertEqual(self.request('/app/instances/'), (None, None))
+        self.assertEqual(self.request('/app/queue/foo/http://e.com/',
+                                      method='POST', body='{}',
+                                      content_type='application/json'),
+                         (None, None))
+        # GET is refused by the Django view.
+        self.assertEqual(self.request('/app/queue/foo/bulk/'), (None, None))
+        self.assertEqual(self.fallback.call_count, 3)
+
+    @patch('cyme.api.fastpath.request_finished')
+    @patch('cyme.api.fastpath.request_started')
+    @patch('cyme.api.fastpath.apply_webhook')
+    def test_request_signals(self, apply_webhook, request_started,
+            request_finished):
+        apply_webhook.side_effect = KeyError('foo')
+        self.assertEqual(self.request('/app/queue/foo/http://e.com/')[0],
+                         500)
+        request_started.send.assert_called_with(sender=FastPath)
+        request_finished.send.assert_called_with(sender=FastPath)
+
+    @patch('cyme.api.fastpath.apply_webhook')
+    def test_apply(self, apply_webhook):
+        apply_webhook.return_value = {'uuid': 'id'}
+        self.assertEqual(self.request('/app/queue/foo/http://e.com/',
+                                      query='x=1'),
+                         (202, {'uuid': 'id'}))
+        app, queue, url, method, params, data = apply_webhook.call_args[0]
+        self.assertEqual((app, queue, url, method, data),
+                         ('app', 'foo', 'http://e.com/', 'GET', None))
+        self.assertEqual(params['x'], '1')
+
+    @patch('cyme.api.fastpath.apply_webhook')
+    def test_apply_no_route(self, apply_webhook):
+        apply_webhook.side_effect = NoRouteError('foo')
+        self.assertEqual(self.request('/app/queue/foo/http://e.com/'),
+                         (404, None))
+
+    @patch('cyme.api.fastpath.apply_webhooks')
+    def test_apply_bulk(self, apply_webhooks):
+        apply_webhooks.return_value = ['id1', 'id2']
+        self.assertEqual(self.request('/app/queue/foo/bulk/', method='POST',
+                            body='[{"url": "a"}, {"url": "b"}]',
+                            content_type='application/json'),
+                         (202, ['id1', 'id2']))
+        self.assertEqual(apply_webhooks.call_args[0],
+                         ('app', 'foo', [{'url': 'a'}, {'url': 'b'}]))
+
+    def test_apply_bulk_bad_request(self):
+        status, reply = self.request('/app/queue/foo/bulk/', method='POST',
+                                     body='foo')
+        self.assertEqual(status, 400)
+        self.assertTrue(reply['nok'])
+
+
+class test_task_events(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = TaskEventConsumer('amqp://')
+        self.consumer.is_ready = True
+        self.state = states.PENDING
+        self._recheck = views.EVENTS_RECHECK_INTERVAL
+        views.EVENTS_RECHECK_INTERVAL = 0.01
+
+    def tearDown(self):
+        views.EVENTS_RECHECK_INTERVAL = self._recheck
+
+    def AsyncResult(self, uuid):
+        return Mock(state=self.state,
+                    ready=lambda: self.state in states.READY_STATES)
+
+    @patch('cyme.api.views.apps')
+    @patch('cyme.api.views.AsyncResult')
+    @patch('cyme.api.views.task_events')
+    def test_iter_events_lost(self, task_events, AsyncResult, apps):
+        task_events.get.return_value = self.consumer
+        AsyncResult.side_effect = self.AsyncResult
+        it = views.iter_task_events('app', ['a'], heartbeat=0.01)
+        self.assertEqual(next(it), (states.PENDING,
+                                    {'uuid': 'a', 'state': states.PENDING}))
+        self.state = states.SUCCESS  # the task-succeeded event is lost.
+        self.assertEqual(next(it), (states.SUCCESS,
+                                    {'uuid': 'a', 'state': states.SUCCESS}))
+        self.assertIsNone(next(it))
+        with self.assertRaises(StopIteration):
+            next(it)
+        self.assertFalse(self.consumer.subscribers)
+
+    @patch('cyme.api.views.apps')
+    @patch('cyme.api.views.AsyncResult')
+    @patch('cyme.api.views.task_events')
+    def test_iter_timeout(self, task_events, AsyncResult, apps):
+        task_events.get.return_value = self.consumer
+        AsyncResult.side_effect = self.AsyncResult
+        events = list(views.iter_task_events('app', ['a'], heartbeat=0.01,
+                                             timeout=0.05))
+        self.assertEqual(events[0][0], states.PENDING)
+        self.assertTrue(all(event is None for event in events[1:]))
+
+    @patch('cyme.api.views.apps')
+    @patch('cyme.api.views.AsyncResult')
+    @patch('cyme.api.views.task_events')
+    def test_wait_events_lost(self, task_events, AsyncResult, apps):
+        task_events.get.return_value = self.consumer
+        # the task is ready at the second recheck, but
+        # the task-succeeded event is lost.
+        ready = iter([False, False, True])
+        result = Mock(ready=lambda: next(ready))
+        AsyncResult.side_effect = lambda uuid: result
+        self.assertIs(views.wait_for_task('app', 'a', timeout=10), result)
+        self.assertFalse(self.consumer.subscribers)
+
+    @patch('cyme.api.views.apps')
+    @patch('cyme.api.views.AsyncResult')
+    @patch('cyme.api.views.task_events')
+    def test_wait_timeout(self, task_events, AsyncResult, apps):
+        task_events.get.return_value = self.consumer
+        AsyncResult.side_effect = self.AsyncResult
+        self.assertIsNone(views.wait_for_task('app', 'a', timeout=0.05))
+
+
+class test_bulk_query(unittest.TestCase):
+
+    def test_parse_uuids(self):
+        self.assertListEqual(views.parse_uuids('["a", "b"]'), ['a', 'b'])
+        for body in ('', 'foo', '{"a": 1}', '["a", 1]'):
+            with self.assertRaises(ValueError):
+                views.parse_uuids(body)
+
+    def backend(self, values):
+        backend = Mock()
+        backend.get_key_for_task = lambda uuid: 'key-' + uuid
+        backend.decode = lambda value: {'status': value, 'result': None}
+        backend.mget.return_value = values
+        return backend
+
+    def test_mget_task_metas_list(self):
+        backend = self.backend([states.SUCCESS, None])
+        self.assertDictEqual(views._mget_task_metas(backend, ['a', 'b']),
+                             {'a': {'status': states.SUCCESS,
+                                    'result': None}})
+
+    def test_mget_task_metas_dict(self):
+        backend = self.backend({'key-b': states.FAILURE})
+        self.assertDictEqual(views._mget_task_metas(backend, ['a', 'b']),
+                             {'b': {'status': states.FAILURE,
+                                    'result': None}})
+
+    @patch('cyme.api.views.celery')
+    def test_task_metas_pending(self, celery):
+        celery.backend = self.backend({'key-a': states.SUCCESS})
+        metas = views.task_metas(['a', 'b'])
+        self.assertDictEqual(metas, {
+            'a': {'status': states.SUCCESS, 'result': None},
+            'b': {'status': states.PENDING, 'result': None}})
+
+    @patch('cyme.api.views.celery')
+    def test_task_metas_mget_not_implemented(self, celery):
+        backend = celery.backend = self.backend(None)
+        backend.mget.side_effect = NotImplementedError('mget')
+        backend.get_task_meta = lambda uuid: {'status': states.SUCCESS,
+                                              'result': uuid}
+        self.assertDictEqual(views.task_metas(['a']),
+                             {'a': {'status': states.SUCCESS, 'result': 'a'}})
+
+    @patch('cyme.api.views.apps')
+    def test_post_unknown_app(self, apps):
+        apps.get.side_effect = NoRouteError('foo')
+        with self.assertRaises(NoRouteError):
+            views.task_states().post(Mock(raw_post_data='["a"]'), 'foo')
+
+    @patch('cyme.api.views.apps')
+    def test_post_bad_request(self, apps):
+        response = views.task_states().post(Mock(raw_post_data='foo'),
+                                            'app')
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(deserialize(response.content)['nok'])
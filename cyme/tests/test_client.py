@@ -0,0 +1,105 @@
+from __future__ import absolute_import
+
+import errno
+import requests
+import socket
+
+from celery.tests.utils import unittest
+from mock import Mock
+
+from cyme.client.base import Client, is_connect_error
+from cyme.client.endpoints import Endpoints
+
+
+class test_Client(unittest.TestCase):
+
+    def test_fan_out(self):
+
+        def double(value):
+            if value == 3:
+                raise KeyError(value)
+            return value * 2
+
+        results = Client().fan_out(double, [(i, i) for i in range(5)],
+                                   concurrency=2)
+        self.assertEqual(results.ok, {0: 0, 1: 2, 2: 4, 4: 8})
+        self.assertIsInstance(results.errors[3], KeyError)
+
+    def test_fan_out_empty(self):
+        self.assertEqual(Client().fan_out(None, []), {})
+
+    def client(self, *errors):
+        session = Mock()
+        replies = list(errors) + [Mock(ok=True)]
+
+        def request(method, url, **kwargs):
+            reply = replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+        session.request.side_effect = request
+        return Client(['http://a', 'http://b'], session=session)
+
+    def test_send_retries_safe_methods(self):
+        client = self.client(requests.ConnectionError('connection reset'))
+        self.assertTrue(client._send('GET', '/foo/').ok)
+        self.assertEqual(client.session.request.call_count, 2)
+
+    def test_send_retries_connect_errors(self):
+        client = self.client(requests.ConnectionError(
+            socket.error(errno.ECONNREFUSED, 'Connection refused')))
+        self.assertTrue(client._send('POST', '/foo/').ok)
+        self.assertEqual(client.session.request.call_count, 2)
+
+    def test_send_does_not_retry_sent_requests(self):
+        for method in ('POST', 'PUT', 'DELETE'):
+            client = self.client(requests.ConnectionError('connection reset'))
+            with self.assertRaises(requests.ConnectionError):
+                client._send(method, '/foo/')
+            self.assertEqual(client.session.request.call_count, 1)
+
+    def test_is_connect_error(self):
+        self.assertTrue(is_connect_error(requests.ConnectionError(
+            socket.gaierror(-2, 'Name or service not known'))))
+        self.assertFalse(is_connect_error(requests.ConnectionError(
+            socket.error(errno.ECONNRESET, 'Connection reset by peer'))))
+        self.assertFalse(is_connect_error(requests.ConnectionError()))
+
+    def test_discover_skips_loopback(self):
+        urls = ['http://a:8000', 'http://127.0.0.1:8001']
+        client = Client('http://a:8000')
+        client.root = Mock(return_value=urls)
+        self.assertListEqual(client.discover(), [])
+        client = Client('http://localhost:8000')
+        client.root = Mock(return_value=urls)
+        self.assertListEqual(client.discover(), urls)
+
+
+class test_Endpoints(unittest.TestCase):
+
+    def test_select_lowest_latency(self):
+        endpoints = Endpoints(['http://a', 'http://b/'])
+        a, b = endpoints.endpoints
+        self.assertEqual(b.url, 'http://b')
+        endpoints.succeeded(a, 0.2)
+        endpoints.succeeded(b, 0.1)
+        self.assertIs(endpoints.select(), b)
+        self.assertIs(endpoints.select(exclude=[b]), a)
+        self.assertIsNone(endpoints.select(exclude=[a, b]))
+        self.assertFalse(endpoints.add('http://a/'))
+
+    def test_circuit_breaker(self):
+        endpoints = Endpoints(['http://a', 'http://b'],
+                              failure_threshold=2, reset_timeout=30)
+        a, b = endpoints.endpoints
+        endpoints.succeeded(b, 0.5)
+        endpoints.failed(a)
+        self.assertIs(endpoints.select(), b)
+        endpoints.failed(a)
+        self.assertIsNotNone(a.opened)
+        self.assertIs(endpoints.select(exclude=[b]), a)  # all open/tried.
+        a.opened -= 60
+        self.assertIs(endpoints.select(), a)  # half-open probe.
+        endpoints.succeeded(a, 0.1)
+        self.assertIsNone(a.opened)
+        self.assertEqual(a.failures, 0)
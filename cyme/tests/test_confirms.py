@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+
+from celery.tests.utils import unittest
+from eventlet.event import Event
+from mock import Mock, patch
+
+from cyme.branch.confirms import (ConfirmPublisher, ConfirmsNotSupported,
+                                  PublishNacked)
+
+
+class MockTask(object):
+
+    def __init__(self):
+        self.sent = 0
+
+    def apply_async(self, args, kwargs=None, **options):
+        if args == 'bad':
+            raise ValueError(args)
+        self.sent += 1
+        return Mock(task_id='t%d' % (self.sent, ))
+
+
+class MockConnection(object):
+    connection_errors = (IOError, )
+    channel_errors = ()
+
+    def __init__(self, drain_events):
+        self.drain_events = drain_events
+
+
+class test_ConfirmPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = ConfirmPublisher('amqp://', Mock(), window=0,
+                                          timeout=1.0)
+
+    def batch(self, *args):
+        task = MockTask()
+        return [(task, arg, None, {}, Event()) for arg in args]
+
+    def outcome(self, event):
+        try:
+            return event.wait()
+        except Exception, exc:
+            return type(exc)
+
+    def test_settle(self):
+        p = self.publisher
+        p.unconfirmed = set([1, 2, 3, 4, 5])
+        p.on_ack(2, multiple=True)
+        self.assertSetEqual(p.unconfirmed, set([3, 4, 5]))
+        p.on_nack(4)
+        self.assertSetEqual(p.unconfirmed, set([3, 5]))
+        self.assertSetEqual(p.nacked, set([4]))
+        p.on_nack(5, multiple=True)
+        self.assertSetEqual(p.unconfirmed, set())
+        self.assertSetEqual(p.nacked, set([3, 4, 5]))
+        p.on_ack(6)  # unknown tags are ignored.
+        self.assertSetEqual(p.nacked, set([3, 4, 5]))
+
+    @patch('cyme.branch.confirms.TaskPublisher')
+    def test_flush(self, TaskPublisher):
+        p = self.publisher
+
+        def drain_events(timeout=None):
+            p.on_ack(1)
+            p.on_nack(3)
+            p.on_ack(2, multiple=True)
+
+        batch = self.batch('a', 'bad', 'b', 'c')
+        p._flush(MockConnection(drain_events), Mock(), batch)
+        self.assertListEqual([self.outcome(event) for _, _, _, _, event
+                                in batch],
+                             ['t1', ValueError, 't2', PublishNacked])
+        self.assertFalse(p.unconfirmed)
+        self.assertFalse(p.nacked)
+
+    @patch('cyme.branch.confirms.TaskPublisher')
+    def test_flush_connection_lost(self, TaskPublisher):
+        p = self.publisher
+
+        def drain_events(timeout=None):
+            p.on_ack(1)
+            raise IOError('connection lost')
+
+        batch = self.batch('a', 'b')
+        with self.assertRaises(IOError):
+            p._flush(MockConnection(drain_events), Mock(), batch)
+        self.assertListEqual([self.outcome(event) for _, _, _, _, event
+                                in batch],
+                             ['t1', IOError])
+
+    def test_publish_not_supported(self):
+        self.publisher.supported = False
+        with self.assertRaises(ConfirmsNotSupported):
+            self.publisher.publish(MockTask(), ())
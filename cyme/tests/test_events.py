@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+from celery import states
+from celery.tests.utils import unittest
+from mock import Mock
+
+from cyme.branch.events import RECONNECTED, TaskEvents
+from cyme.branch.heartbeats import Heartbeats
+
+
+class test_TaskEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.consume = Mock()
+        self.events = TaskEvents(self.consume, set_as_current=False)
+
+    def test_get(self):
+        consumer = self.events.get('amqp://')
+        self.assertIs(self.events.get('amqp://'), consumer)
+        self.consume.assert_called_with('amqp://')
+        self.assertFalse(consumer.is_ready)
+        self.assertFalse(consumer.wait_ready(0.01))
+
+    def test_wanted(self):
+        self.assertFalse(self.events.wanted('amqp://'))
+        consumer = self.events.get('amqp://')
+        self.assertFalse(self.events.wanted('amqp://'))
+        queue = consumer.subscribe(['a'])
+        self.assertTrue(self.events.wanted('amqp://'))
+        self.assertFalse(self.events.wanted('redis://'))
+        consumer.unsubscribe(['a'], queue)
+        self.assertFalse(self.events.wanted('amqp://'))
+
+    def test_on_event(self):
+        consumer = self.events.get('amqp://')
+        queue = consumer.subscribe(['a', 'b'])
+        self.events.on_event('amqp://', {'type': 'task-succeeded',
+                                         'uuid': 'a'})
+        self.events.on_event('amqp://', {'type': 'task-started',
+                                         'uuid': 'c'})
+        self.events.on_event('amqp://', {'type': 'worker-heartbeat'})
+        self.events.on_event('redis://', {'type': 'task-started',
+                                          'uuid': 'b'})
+        event = queue.get_nowait()
+        self.assertEqual(event['uuid'], 'a')
+        self.assertEqual(event['state'], states.SUCCESS)
+        self.assertTrue(queue.empty())
+
+        consumer.unsubscribe(['a', 'b'], queue)
+        self.assertFalse(consumer.subscribers)
+
+    def test_reconnect(self):
+        consumer = self.events.get('amqp://')
+        queue = consumer.subscribe(['a'])
+        self.events.on_bound('amqp://')
+        self.assertTrue(consumer.is_ready)
+        self.assertIs(queue.get_nowait(), RECONNECTED)
+
+        self.events.on_unbound('amqp://')
+        self.assertFalse(consumer.is_ready)
+        self.assertFalse(consumer.wait_ready(0.01))
+        self.events.on_bound('amqp://')
+        self.assertTrue(consumer.wait_ready(0.01))
+        self.assertIs(queue.get_nowait(), RECONNECTED)
+
+
+class test_Heartbeats(unittest.TestCase):
+
+    def setUp(self):
+        self.heartbeats = Heartbeats(set_as_current=False)
+        self.task_events = self.heartbeats.task_events
+        self.task_events.consume = Mock()
+
+    def test_receiver_binds_worker_events(self):
+        receiver = self.heartbeats.Receiver(Mock(), 'amqp://')
+        self.assertEqual(receiver.routing_key, 'worker.#')
+
+    def test_bind_task_events(self):
+        queue = Mock()
+        bind = self.heartbeats._bind_task_events
+
+        self.assertFalse(bind('amqp://', queue, False))
+        self.assertFalse(queue.bind_to.call_count)
+
+        consumer = self.task_events.get('amqp://')
+        subscription = consumer.subscribe(['a'])
+        self.assertFalse(bind('redis://', queue, False))
+        self.assertFalse(queue.bind_to.call_count)
+        self.assertTrue(bind('amqp://', queue, False))
+        queue.bind_to.assert_called_with(queue.exchange,
+                                         routing_key='task.#')
+        self.assertTrue(consumer.is_ready)
+        self.assertTrue(bind('amqp://', queue, True))
+        self.assertEqual(queue.bind_to.call_count, 1)
+
+        consumer.unsubscribe(['a'], subscription)
+        self.assertFalse(bind('amqp://', queue, True))
+        queue.unbind_from.assert_called_with(queue.exchange,
+                                             routing_key='task.#')
+        self.assertFalse(consumer.is_ready)
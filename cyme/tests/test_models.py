@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 from celery.tests.utils import unittest
+from django.db import connection
 from mock import Mock
 
 from cyme.models import Instance, Queue
@@ -54,6 +55,13 @@ class test_Instance(unittest.TestCase):
         n1.enable()
         self.assertTrue(Instance.objects.get(name=n1.name).is_enabled)
 
+    def test_version(self):
+        n = Instance.objects.add()
+        version = n.version
+        n.disable()
+        self.assertEqual(Instance.objects.get(name=n.name).version,
+                         version + 1)
+
     def test_start_stop_restart(self):
         n = Instance.objects.add()
         n.start()
@@ -86,3 +94,53 @@ class test_Instance(unittest.TestCase):
 
         Instance.objects.remove_queue('foo')
         Instance.objects.remove_queue('xaz')
+
+    def test_queue_index(self):
+        n1 = Instance.objects.add(queues='foo,bar')
+        n2 = Instance.objects.add(queues='bar')
+        self.assertItemsEqual(Instance.objects.consuming_from('bar'),
+                              [n1, n2])
+
+        self.assertItemsEqual(
+                Instance.objects.remove_queue_from_instances('bar'),
+                [n1, n2])
+        self.assertFalse(Instance.objects.consuming_from('bar'))
+        self.assertEqual(list(Instance.objects.get(name=n1.name).queues),
+                         ['foo'])
+
+    def test_queues_is_copy(self):
+        n = Instance.objects.add(queues='foo')
+        n.queues.append('bar')
+        self.assertEqual(list(n.queues), ['foo'])
+        n.queues.add('bar')
+        self.assertEqual(list(n.queues), ['foo', 'bar'])
+
+    def test_maybe_build_queue_index(self):
+        n = Instance.objects.add(queues='foo')
+        self.assertFalse(Instance.objects.maybe_build_queue_index())
+        n.consumers.all().delete()
+        self.assertTrue(Instance.objects.maybe_build_queue_index())
+        self.assertItemsEqual(Instance.objects.consuming_from('foo'), [n])
+
+    def test_maybe_add_version_column(self):
+        self.assertFalse(Instance.objects.maybe_add_version_column())
+        n = Instance.objects.add(queues='foo')
+        # recreate the table as it was before the version column.
+        qn = connection.ops.quote_name
+        table = Instance._meta.db_table
+        columns = ', '.join(qn(field.column)
+                                for field in Instance._meta.fields
+                                    if field.name != 'version')
+        cursor = connection.cursor()
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (
+            qn(table), qn(table + '_new')))
+        try:
+            cursor.execute('CREATE TABLE %s AS SELECT %s FROM %s' % (
+                qn(table), columns, qn(table + '_new')))
+            self.assertTrue(Instance.objects.maybe_add_version_column())
+            self.assertFalse(Instance.objects.maybe_add_version_column())
+            self.assertEqual(Instance.objects.get(name=n.name).version, 0)
+        finally:
+            cursor.execute('DROP TABLE %s' % (qn(table), ))
+            cursor.execute('ALTER TABLE %s RENAME TO %s' % (
+                qn(table + '_new'), qn(table)))
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+
+from celery.tests.utils import unittest
+
+from cyme.branch.placement import (BinPacking, LeastLoaded, Spread,
+                                   get_policy)
+
+
+def branch(id, load=0.0, cpus=1, disk_use=10, instances=0, processes=0):
+    return {'id': id, 'load_average': (load, load, load), 'cpus': cpus,
+            'disk_use': disk_use, 'instances': instances,
+            'processes': processes}
+
+
+class test_policies(unittest.TestCase):
+
+    def test_no_branches(self):
+        self.assertIsNone(LeastLoaded().select([], {}))
+
+    def test_least_loaded(self):
+        branches = [branch('a', load=2.0, cpus=1),
+                    branch('b', load=4.0, cpus=2),
+                    branch('c', load=0.5, cpus=1, processes=2),
+                    branch('d', load=0.5, cpus=1, processes=1)]
+        self.assertEqual(LeastLoaded().select(branches, {}), 'd')
+
+    def test_disk_use(self):
+        branches = [branch('a', load=0.0, disk_use=99),
+                    branch('b', load=1.0, disk_use=50)]
+        self.assertEqual(LeastLoaded().select(branches, {}), 'b')
+        self.assertEqual(LeastLoaded().select(branches[:1], {}), 'a')
+        self.assertEqual(
+            LeastLoaded(max_disk_use=100).select(branches, {}), 'a')
+
+    def test_spread(self):
+        branches = [branch('a', instances=3),
+                    branch('b', instances=1, processes=4),
+                    branch('c', instances=1, processes=2)]
+        self.assertEqual(Spread().select(branches, {}), 'c')
+
+    def test_bin_packing(self):
+        branches = [branch('a', cpus=1, processes=3),
+                    branch('b', cpus=1, processes=1),
+                    branch('c', load=1.0, cpus=1, processes=0)]
+        policy = BinPacking(capacity=4)
+        self.assertEqual(policy.select(branches, {}), 'a')
+        self.assertEqual(policy.select(branches, {'max_concurrency': 2}),
+                         'b')
+        # none have room, so the least loaded is selected.
+        self.assertEqual(policy.select(branches, {'max_concurrency': 8}),
+                         'b')
+
+    def test_get_policy(self):
+        self.assertIsNone(get_policy('round-robin'))
+        self.assertIsInstance(get_policy('spread'), Spread)
+        self.assertIsInstance(get_policy('bin-packing'), BinPacking)
+        self.assertIsInstance(
+            get_policy('cyme.branch.placement.LeastLoaded'), LeastLoaded)
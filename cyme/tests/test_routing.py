@@ -0,0 +1,48 @@
+from __future__ import absolute_import
+
+from celery.tests.utils import unittest
+
+from cyme.branch.routing import RoutingIndex, VersionedMeta
+
+
+class test_RoutingIndex(unittest.TestCase):
+
+    def test_update_remove(self):
+        index = RoutingIndex()
+        index.update('a', {'Instance': {'instances': ['x', 'y']}})
+        index.update('b', {'Instance': {'instances': ['z']}})
+        self.assertEqual(index.owner('Instance', 'instances', 'x'), 'a')
+        self.assertEqual(index.owner('Instance', 'instances', 'z'), 'b')
+        self.assertItemsEqual(index.values('Instance', 'instances'),
+                              ['x', 'y', 'z'])
+
+        index.update('a', {'Instance': {'instances': ['y']}})
+        self.assertIsNone(index.owner('Instance', 'instances', 'x'))
+        self.assertTrue(index.indexes('a', 'Instance'))
+
+        index.remove('b')
+        self.assertIsNone(index.owner('Instance', 'instances', 'z'))
+        self.assertFalse(index.indexes('b', 'Instance'))
+
+    def test_delta(self):
+        index = RoutingIndex()
+        meta = VersionedMeta('instances', lambda: names)
+        names = ['x']
+        index.update('a', {'Instance': meta()})
+        names = ['x', 'y']
+        meta.changed()
+        delta = meta()
+        self.assertEqual(delta['added'], {'instances': ['y']})
+        index.update('a', {'Instance': delta})
+        self.assertEqual(index.owner('Instance', 'instances', 'y'), 'a')
+        self.assertTrue(index.indexes('a', 'Instance'))
+
+        names = ['y']
+        meta.changed()
+        meta()  # delta lost
+        index.update('a', {'Instance': meta()})
+        self.assertFalse(index.indexes('a', 'Instance'))
+
+        index.update('a', {'Instance': meta(snapshot=True)})
+        self.assertTrue(index.indexes('a', 'Instance'))
+        self.assertIsNone(index.owner('Instance', 'instances', 'x'))
@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+
+from celery.tests.utils import unittest
+
+from cyme.branch.supervisor import (Supervisor, Request,
+                                    PRIORITY_INTERACTIVE, PRIORITY_PERIODIC)
+
+
+class MockInstance(object):
+
+    def __init__(self, name, version=1):
+        self.name = name
+        self.version = version
+
+
+class test_Supervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.sup = Supervisor(set_as_current=False)
+        self.sup.spawn = lambda fun, *args, **kwargs: None
+        self.calls = []
+
+    def action(self, instance, **kwargs):
+        self.calls.append((instance.name, kwargs))
+
+    def jobs(self):
+        """Returns the jobs not cancelled, in the order dispatched."""
+        jobs = []
+        while not self.sup.queue.empty():
+            job = self.sup.queue.get_nowait()[2]
+            if self.sup._dispatch(job):
+                jobs.append(job)
+        return jobs
+
+    def test_priority(self):
+        a, b, c = MockInstance('a'), MockInstance('b'), MockInstance('c')
+        self.sup._request([a, b], self.action, priority=PRIORITY_PERIODIC)
+        self.sup._request([c], self.action)
+        self.assertListEqual([job.name for job in self.jobs()],
+                             ['c', 'a', 'b'])
+
+    def test_request_order_kept(self):
+        c, b1, a, b2 = (MockInstance('c'), MockInstance('b', 1),
+                        MockInstance('a'), MockInstance('b', 2))
+        self.sup._request([c, b1, a, b2], self.action)
+        jobs = self.jobs()
+        self.assertListEqual([job.name for job in jobs], ['c', 'b', 'a'])
+        self.assertIs(jobs[1].instance, b2)
+
+    def test_instance_order_kept(self):
+        a = MockInstance('a')
+        self.sup._request([a], self.action, {'x': 1},
+                          priority=PRIORITY_PERIODIC)
+        self.sup._request([a], self.action, {'x': 2})
+        jobs = self.jobs()
+        self.assertListEqual([job.request.kwargs for job in jobs],
+                             [{'x': 1}, {'x': 2}])
+        self.assertListEqual([job.priority for job in jobs],
+                             [PRIORITY_INTERACTIVE, PRIORITY_INTERACTIVE])
+
+    def test_merge(self):
+        a1, a2 = MockInstance('a', 1), MockInstance('a', 2)
+        self.sup._request([a1], self.action, {'ratelimit': True},
+                          priority=PRIORITY_PERIODIC, merge=True)
+        self.sup._request([a2], self.action, {'ratelimit': True},
+                          priority=PRIORITY_PERIODIC, merge=True)
+        jobs = self.jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertIs(jobs[0].instance, a2)
+
+    def test_merge_requires_same_kwargs(self):
+        a = MockInstance('a')
+        self.sup._request([a], self.action, {'ratelimit': True},
+                          priority=PRIORITY_PERIODIC, merge=True)
+        self.sup._request([a], self.action, {'ratelimit': False},
+                          priority=PRIORITY_PERIODIC, merge=True)
+        self.assertListEqual([job.request.kwargs for job in self.jobs()],
+                             [{'ratelimit': True}, {'ratelimit': False}])
+
+    def test_supersede(self):
+        a = MockInstance('a')
+        self.sup._request([a], self.action, {'ratelimit': False},
+                          priority=PRIORITY_PERIODIC, merge=True)
+        periodic = self.sup._pending_verify['a']
+        self.sup._request([a], self.action, {'ratelimit': False},
+                          merge=True)
+        self.assertTrue(periodic.cancelled)
+        jobs = self.jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0].priority, PRIORITY_INTERACTIVE)
+        self.assertFalse(self.sup._pending_verify)
+
+    def test_tails(self):
+        a = MockInstance('a')
+        self.sup._request([a], self.action, {'x': 1})
+        self.sup._request([a], self.action, {'x': 2})
+        first, second = self.jobs()
+        self.assertIsNone(first.after)
+        self.assertIs(second.after, first.done)
+        self.assertIs(self.sup._tails['a'], second)
+        self.sup._run_job(first)
+        self.assertIs(self.sup._tails['a'], second)
+        self.sup._run_job(second)
+        self.assertNotIn('a', self.sup._tails)
+        self.assertListEqual(self.calls, [('a', {'x': 1}), ('a', {'x': 2})])
+
+
+class test_Request(unittest.TestCase):
+
+    def test_get_kwargs_snapshot(self):
+        snapshots = []
+
+        def probe():
+            snapshots.append(len(snapshots))
+            return snapshots[-1]
+
+        request = Request(None, {'ratelimit': True}, probe=probe)
+        self.assertDictEqual(request.get_kwargs(),
+                             {'ratelimit': True, 'snapshot': 0})
+        self.assertDictEqual(request.get_kwargs(),
+                             {'ratelimit': True, 'snapshot': 0})
+        request.snapshot_max_age = -1
+        self.assertDictEqual(request.get_kwargs(),
+                             {'ratelimit': True, 'snapshot': 1})
+
+    def test_get_kwargs_no_probe(self):
+        request = Request(None, {'ratelimit': True})
+        self.assertDictEqual(request.get_kwargs(), {'ratelimit': True})
+
+    def test_get_kwargs_probe_failed(self):
+        request = Request(None, {'ratelimit': True}, probe=lambda: None)
+        self.assertDictEqual(request.get_kwargs(), {'ratelimit': True})
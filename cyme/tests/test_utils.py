@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+
+from celery.tests.utils import unittest
+from eventlet import GreenPool, sleep
+from eventlet.semaphore import Semaphore
+from mock import patch
+
+from cyme.utils import LockMap, LRUCache
+
+
+class test_LRUCache(unittest.TestCase):
+
+    def test_limit(self):
+        cache = LRUCache(limit=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache['a'], 1)
+        cache['c'] = 3
+        with self.assertRaises(KeyError):
+            cache['b']
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=-1)
+        cache['a'] = 1
+        with self.assertRaises(KeyError):
+            cache['a']
+        self.assertEqual(cache.pop('a', None), None)
+
+
+class test_LockMap(unittest.TestCase):
+
+    def test_lock_released(self):
+        locks = LockMap()
+        with locks['a'] as lock:
+            self.assertFalse(lock.acquire(False))
+            with locks['b']:
+                self.assertEqual(len(locks), 2)
+        self.assertEqual(len(locks), 0)
+
+    def test_lock_released_on_error(self):
+        locks = LockMap()
+        with self.assertRaises(KeyError):
+            with locks['a']:
+                raise KeyError('a')
+        self.assertEqual(len(locks), 0)
+
+    def test_green_once_patched(self):
+        # created before eventlet patched threading,
+        # like the class attribute Instance.locks.
+        locks, cache = LockMap(), LRUCache()
+        held = []
+
+        def hold(n):
+            with locks['a']:
+                held.append(n)
+                sleep(0.01)  # switches to the other green thread.
+                held.append(n)
+
+        with patch('threading.Lock', Semaphore):
+            pool = GreenPool()
+            pool.spawn(hold, 1)
+            pool.spawn(hold, 2)
+            pool.waitall()
+            self.assertIsInstance(cache._mutex, Semaphore)
+        self.assertListEqual(held, [1, 1, 2, 2])
+        self.assertEqual(len(locks), 0)
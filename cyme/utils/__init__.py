@@ -1,9 +1,14 @@
 """cyme.utils"""
 from __future__ import absolute_import
+from __future__ import with_statement
 
 import sys
+import threading
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from importlib import import_module
+from time import time
 
 from celery import current_app as celery
 from celery.utils import get_cls_by_name
@@ -29,6 +34,144 @@ def force_list(obj):
     return obj
 
 
+class LockMap(object):
+    """Mapping of keys to locks, used as a context manager
+    acquiring the lock for a key::
+
+        >>> with locks[key]:
+        ...     pass
+
+    The lock for a key only exists while it is held or waited for,
+    so the map does not grow with the number of keys ever used.
+
+    :keyword lock_type: Lock class to use (default is
+        :class:`threading.Lock`, looked up when first used so that
+        the locks are green once eventlet has patched :mod:`threading`).
+
+    """
+
+    def __init__(self, lock_type=None):
+        self._lock_type = lock_type
+        # key -> [lock, number of holders and waiters]
+        self._locks = {}
+
+    @property
+    def lock_type(self):
+        return self._lock_type or threading.Lock
+
+    @cached_property
+    def _mutex(self):
+        return threading.Lock()
+
+    def __getitem__(self, key):
+        return self._hold(key)
+
+    @contextmanager
+    def _hold(self, key):
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [self.lock_type(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield entry[0]
+        finally:
+            with self._mutex:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class LRUCache(object):
+    """Size-bounded mapping evicting the least recently used keys,
+    where entries can also expire after a number of seconds.
+
+    :keyword limit: Max number of entries (default is no limit).
+    :keyword ttl: Entries expire after this number of seconds
+        (as an int/float, default is never).
+
+    The number of cache hits and misses are kept in the
+    :attr:`hits` and :attr:`misses` attributes.
+
+    """
+
+    def __init__(self, limit=None, ttl=None):
+        self.limit = limit
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+
+    @cached_property
+    def _mutex(self):
+        # created when first used, as the cache may be created
+        # before eventlet has patched threading.
+        return threading.Lock()
+
+    def __getitem__(self, key):
+        with self._mutex:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            if expires is not None and time() > expires:
+                self.misses += 1
+                raise KeyError(key)
+            self._data[key] = value, expires  # most recently used.
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._mutex:
+            self._data.pop(key, None)
+            expires = time() + self.ttl if self.ttl else None
+            self._data[key] = value, expires
+            if self.limit:
+                while len(self._data) > self.limit:
+                    self._data.popitem(last=False)
+
+    def pop(self, key, *default):
+        with self._mutex:
+            try:
+                return self._data.pop(key)[0]
+            except KeyError:
+                if default:
+                    return default[0]
+                raise
+
+    def clear(self):
+        with self._mutex:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def info(self):
+        """Returns a dict with the size and hit/miss counters."""
+        return {'size': len(self), 'limit': self.limit, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class DummyLock(object):
+    """Lock that can always be acquired."""
+
+    def acquire(self, *args, **kwargs):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
 def find_package(mod, _s=None):
     """Find the package a module belongs to.
 
@@ -125,7 +125,7 @@ setup(
         "dnspython",
         "Django",
         "django-celery>=2.3.1",
-        "requests",
+        "requests>=1.0",
         "dictshield",
         "progressbar",
         "unipath",